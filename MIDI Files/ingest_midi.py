@@ -0,0 +1,238 @@
+'''
+MIDI CORPUS INGESTION
+Converts a whole directory tree of .mid files into the training store for the music model.
+The files are parsed with midi_events.py on a process pool and their note events are
+appended to shards (shards/events-NNNNN.npy, EVENT_DTYPE arrays that np.load can memory
+map). index.npy has one row per (file, track) with the shard, offset and length of that
+track's events, and files.json keeps the path, mtime, size, sha1, ticks_per_beat and
+tempo changes of every file.
+
+Re-runs only convert new or changed files: a file whose mtime and size didn't change
+is skipped without being read, one whose content hash didn't change is skipped without
+being parsed. Entries of changed or deleted files are dropped from the index and shards
+nobody points to anymore are removed.
+
+Run with: python ingest_midi.py <midi directory> <output directory> [workers]
+'''
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import midi_events
+
+INDEX_DTYPE = np.dtype([
+        ('file', np.uint32), # position in files.json
+        ('track', np.uint16),
+        ('shard', np.uint32),
+        ('offset', np.uint64), # first event of the track in the shard
+        ('length', np.uint64), # number of events
+])
+
+#events per shard before a new one is started
+SHARD_SIZE = 1 << 20
+
+MIDI_EXTENSIONS = ('.mid', '.midi')
+
+def shard_path(out_dir, shard):
+    return os.path.join(out_dir, 'shards', 'events-{:05d}.npy'.format(shard))
+
+def find_midi_files(midi_dir):
+    paths = []
+    for root, dirs, files in os.walk(midi_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(MIDI_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+    return paths
+
+#worker: hash and parse one file. Returns (sha1, midi or None if the hash matched known_sha1, error)
+def convert_file(path, known_sha1=None):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        sha1 = hashlib.sha1(data).hexdigest()
+        if sha1 == known_sha1:
+            return sha1, None, None
+
+        return sha1, midi_events.parse_midi(data), None
+    except Exception as e:
+        return None, None, '{}: {}'.format(type(e).__name__, e)
+
+def load_store(out_dir):
+    files_path = os.path.join(out_dir, 'files.json')
+    if not os.path.exists(files_path):
+        return {'files': [], 'next_shard': 0}, np.zeros(0, dtype=INDEX_DTYPE)
+
+    with open(files_path) as f:
+        store = json.load(f)
+    return store, np.load(os.path.join(out_dir, 'index.npy'))
+
+#index.npy first, files.json last, so files.json never points at an index that isn't there yet
+def save_store(out_dir, store, index):
+    np.save(os.path.join(out_dir, 'index.tmp.npy'), index)
+    os.replace(os.path.join(out_dir, 'index.tmp.npy'), os.path.join(out_dir, 'index.npy'))
+
+    with open(os.path.join(out_dir, 'files.json.tmp'), 'w') as f:
+        json.dump(store, f)
+    os.replace(os.path.join(out_dir, 'files.json.tmp'), os.path.join(out_dir, 'files.json'))
+
+#collects converted files until the shard is full, then writes it
+class ShardWriter(object):
+    def __init__(self, out_dir, first_shard, shard_size=SHARD_SIZE):
+        self.out_dir = out_dir
+        self.shard = first_shard
+        self.shard_size = shard_size
+        self.pending = []
+        self.pending_events = 0
+        self.index = []
+
+    def add(self, file_id, events):
+        #the events come sorted by track, so every track is one contiguous run
+        tracks, starts, counts = np.unique(events['track'], return_index=True, return_counts=True)
+        for track, start, count in zip(tracks, starts, counts):
+            self.index.append((file_id, track, self.shard, self.pending_events + start, count))
+
+        self.pending.append(events)
+        self.pending_events += len(events)
+
+        if self.pending_events >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        np.save(shard_path(self.out_dir, self.shard), np.concatenate(self.pending))
+        self.shard += 1
+        self.pending = []
+        self.pending_events = 0
+
+def ingest(midi_dir, out_dir, workers=None, shard_size=SHARD_SIZE):
+    start = time.time()
+    os.makedirs(os.path.join(out_dir, 'shards'), exist_ok=True)
+
+    store, index = load_store(out_dir)
+    known = {entry['path']: (file_id, entry) for file_id, entry in enumerate(store['files'])}
+
+    files = []
+    kept_ids = []
+    to_convert = []
+
+    for path in find_midi_files(midi_dir):
+        rel = os.path.relpath(path, midi_dir)
+        stat = os.stat(path)
+        file_id, entry = known.get(rel, (None, None))
+
+        if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            files.append(entry)
+            kept_ids.append(file_id)
+        else:
+            to_convert.append((path, rel, stat, file_id, entry))
+
+    print('{} files unchanged, {} to check'.format(len(files), len(to_convert)))
+
+    writer = ShardWriter(out_dir, store['next_shard'], shard_size)
+    new_files = []
+    failed = 0
+
+    with ProcessPoolExecutor(workers) as pool:
+        results = pool.map(convert_file,
+                [path for path, _, _, _, _ in to_convert],
+                [entry['sha1'] if entry else None for _, _, _, _, entry in to_convert],
+                chunksize=8)
+
+        for (path, rel, stat, file_id, entry), (sha1, midi, error) in zip(to_convert, results):
+            if error is not None:
+                print('Skipping {} ({})'.format(path, error))
+                failed += 1
+                continue
+
+            if midi is None:
+                #touched but not changed
+                entry = dict(entry, mtime=stat.st_mtime, size=stat.st_size)
+                files.append(entry)
+                kept_ids.append(file_id)
+                continue
+
+            new_file_id = len(new_files)
+            new_files.append({'path': rel, 'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': sha1,
+                    'ticks_per_beat': midi.ticks_per_beat, 'tempos': midi.tempos.tolist()})
+            writer.add(new_file_id, midi.events)
+
+    writer.flush()
+
+    #keep the index rows of the unchanged files (renumbered), then add the new ones after them
+    remap = np.full(len(store['files']) + 1, -1, dtype=np.int64)
+    remap[kept_ids] = np.arange(len(kept_ids))
+    index = index[remap[index['file']] >= 0]
+    index['file'] = remap[index['file']]
+
+    new_index = np.array(writer.index, dtype=INDEX_DTYPE)
+    new_index['file'] += len(files)
+    index = np.concatenate([index, new_index])
+
+    store = {'files': files + new_files, 'next_shard': writer.shard}
+    save_store(out_dir, store, index)
+
+    #remove the shards that only held events of changed or deleted files
+    used = set(index['shard'].tolist())
+    for shard in range(writer.shard):
+        if shard not in used and os.path.exists(shard_path(out_dir, shard)):
+            os.remove(shard_path(out_dir, shard))
+
+    print('Converted {} files ({} failed) in {:.1f} secs, {} files in the store'.format(
+            len(new_files), failed, time.time() - start, len(store['files'])))
+    return store, index
+
+'''
+READING THE STORE
+'''
+#returns (files, index, shards), the shards are memory mapped and only read when used
+def load_corpus(out_dir):
+    store, index = load_store(out_dir)
+    shards = {shard: np.load(shard_path(out_dir, shard), mmap_mode='r')
+            for shard in np.unique(index['shard']).tolist()}
+    return store['files'], index, shards
+
+#events of one file (all of its tracks, or just one), as views into the memory mapped shard
+def file_events(index, shards, file_id, track=None):
+    rows = index[index['file'] == file_id]
+    if track is not None:
+        rows = rows[rows['track'] == track]
+
+    return rows_events(shards, rows)
+
+#events of the given index rows, in their order
+def rows_events(shards, rows):
+    parts = [shards[int(row['shard'])][int(row['offset']):int(row['offset'] + row['length'])] for row in rows]
+    if len(parts) == 1:
+        return parts[0]
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=midi_events.EVENT_DTYPE)
+
+#events of index rows that all point into the same shard, in the order of the shard.
+#Picked with one mask instead of a slice per row
+def shard_events(shard, rows):
+    edges = np.zeros(len(shard) + 1, dtype=np.int64)
+    np.add.at(edges, rows['offset'].astype(np.int64), 1)
+    np.add.at(edges, (rows['offset'] + rows['length']).astype(np.int64), -1)
+    return shard[np.cumsum(edges[:-1]) > 0]
+
+#index rows split into groups by one of its columns, with a single sort instead of a scan
+#of the whole index per group. Returns (values, groups), the rows keep their order in a group
+def group_rows(index, column):
+    rows = index[np.argsort(index[column], kind='stable')]
+    values, starts = np.unique(rows[column], return_index=True)
+    return values, np.split(rows, starts[1:])
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('usage: python ingest_midi.py <midi directory> <output directory> [workers]')
+        sys.exit(1)
+
+    ingest(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else None)
@@ -1,92 +1,141 @@
-lineList = [line.rstrip('\n') for line in open("./Mozart output")]
-
-def isnumeric(c):
-	flag = True
-	for i in range(0, len(c)):
-		if ord(c[i]) >= 48 and ord(c[i]) < 58:
-			pass
-		else:
-			flag = False
-	return flag
-
-def atoi(c):
-	if ord(c) >= 48 and ord(c) < 58:
-		return ord(c) - 48
-
-listOfNotes = []
-minNote = 1000
-maxNote = 0
-
-minVelocity = 1000
-maxVelocity = 0
-
-minTime = 10000
-maxTime = 0
-
-
-t = 0
-for line in lineList:
-	numericLine = ""
-	noteAttribs = []
-	if line[0:7] == "note_on":
-		numericLine += "1 " 
-		noteAttribs.append(1)
-	elif line[0:8] == "note_off":
-		numericLine += "0 "
-		noteAttribs.append(0)
+'''
+Normalizes the note events of a midi file (see midi_events.py) into float rows of
+[on/off, note, velocity, delta time, position], with note, velocity and delta scaled
+to [0, 1] by their min and range, and position running from 0 to 1 over the file.
+
+The min/max of every field are kept in a json sidecar, so the same stats can be
+computed once over a whole corpus (merged shard by shard, see corpus_stats), applied
+to new files, and used to turn generated rows back into midi values (denormalize).
+
+Run with:
+	python makeReady.py file.mid [stats.json]
+		writes file.norm.npy, using the given stats or writing file.stats.json
+	python makeReady.py --corpus <ingested store directory>
+		updates <store>/stats.json with the shards that aren't in it yet
+'''
+import json
+import os
+import sys
+
+import numpy as np
+
+import midi_events
+
+FIELDS = ('note', 'velocity', 'delta')
+
+#min/max of every field, plus the number of events they cover
+def compute_stats(events):
+	stats = {'count': int(len(events))}
+	for field in FIELDS:
+		column = events[field]
+		stats[field] = {'min': int(column.min()) if len(column) else None,
+				'max': int(column.max()) if len(column) else None}
+	return stats
+
+def merge_stats(a, b):
+	merged = {'count': a['count'] + b['count']}
+	for field in FIELDS:
+		mins = [s[field]['min'] for s in (a, b) if s[field]['min'] is not None]
+		maxs = [s[field]['max'] for s in (a, b) if s[field]['max'] is not None]
+		merged[field] = {'min': min(mins) if mins else None, 'max': max(maxs) if maxs else None}
+	return merged
+
+def empty_stats():
+	return {'count': 0, **{field: {'min': None, 'max': None} for field in FIELDS}}
+
+def save_stats(stats, path):
+	with open(path + '.tmp', 'w') as f:
+		json.dump(stats, f, indent=1)
+	os.replace(path + '.tmp', path)
+
+def load_stats(path):
+	with open(path) as f:
+		return json.load(f)
+
+def field_scale(stats, field):
+	low, high = stats[field]['min'], stats[field]['max']
+	#a field that never changes maps to 0 instead of dividing by zero
+	return float(low), float(max(high - low, 1))
+
+#(n, 5) float32 rows of [on/off, note, velocity, delta, position]
+def normalize(events, stats):
+	rows = np.empty((len(events), 5), dtype=np.float32)
+	rows[:, 0] = events['type']
+
+	for column, field in enumerate(FIELDS, 1):
+		low, scale = field_scale(stats, field)
+		rows[:, column] = (events[field] - low) / scale
+
+	rows[:, 4] = np.arange(len(events)) / float(max(len(events) - 1, 1))
+	return rows
+
+#normalized (or generated) rows back to an EVENT_DTYPE array, rounded and clipped to valid midi values
+def denormalize(rows, stats, track=0, channel=0):
+	rows = np.asarray(rows, dtype=np.float64)
+	events = np.zeros(len(rows), dtype=midi_events.EVENT_DTYPE)
+
+	events['track'] = track
+	events['channel'] = channel
+	events['type'] = rows[:, 0] >= 0.5
+
+	limits = {'note': 127, 'velocity': 127, 'delta': np.iinfo(np.uint32).max}
+	for column, field in enumerate(FIELDS, 1):
+		low, scale = field_scale(stats, field)
+		events[field] = np.clip(np.rint(rows[:, column] * scale + low), 0, limits[field])
+
+	events['tick'] = np.cumsum(events['delta'], dtype=np.uint64)
+	return events
+
+#stats over an ingested corpus (see ingest_midi.py). The stats.json sidecar remembers the
+#sha1 of every file it covers, so a re-run only reads the files added since. If a file it
+#covered was changed or removed the stats are rebuilt, since a min/max can't be taken back out
+def corpus_stats(store_dir):
+	import ingest_midi
+
+	path = os.path.join(store_dir, 'stats.json')
+	files, index, shards = ingest_midi.load_corpus(store_dir)
+	hashes = [entry['sha1'] for entry in files]
+
+	stats = load_stats(path) if os.path.exists(path) else dict(empty_stats(), files=[])
+	if not set(stats['files']) <= set(hashes):
+		print('Files were changed or removed, recomputing the stats')
+		stats = dict(empty_stats(), files=[])
+
+	covered = set(stats['files'])
+	new_ids = [file_id for file_id, sha1 in enumerate(hashes) if sha1 not in covered]
+
+	#the index rows of the new files, grouped by shard. Through the index, since shards can
+	#still hold the old events of changed files
+	rows = index[np.isin(index['file'], new_ids)]
+	for shard, shard_rows in zip(*ingest_midi.group_rows(rows, 'shard')):
+		stats = dict(merge_stats(stats, compute_stats(ingest_midi.shard_events(shards[int(shard)], shard_rows))),
+				files=stats['files'])
+	stats['files'] = stats['files'] + [hashes[file_id] for file_id in new_ids]
+
+	save_stats(stats, path)
+	return stats
+
+def print_stats(stats):
+	for field in FIELDS:
+		print('<', field, stats[field]['min'], stats[field]['max'], '>')
+	print('<', 0, stats['count'] - 1, '>')
+
+if __name__ == '__main__':
+	if len(sys.argv) > 2 and sys.argv[1] == '--corpus':
+		print_stats(corpus_stats(sys.argv[2]))
+		sys.exit(0)
+
+	midi_path = sys.argv[1] if len(sys.argv) > 1 else 'mozart.mid'
+	events = midi_events.read_midi(midi_path).events
+
+	if len(sys.argv) > 2:
+		stats = load_stats(sys.argv[2])
 	else:
-		continue	
-	for c in range(0,len(line)):
-		if line[c:c+5] == "note=":
-			l = 0
-			note = line[c+5]
-			while isnumeric(line[c+5:c+5+l]):
-				note = line[c+5:c+5+l]
-				l += 1
-			noteAttribs.append(int(note))
-			
-			if int(note) > maxNote:
-				maxNote = int(note)
-			if int(note) < minNote:
-				minNote = int(note)
-		if line[c:c+9] == "velocity=":
-			l = 0
-			velocity = line[c+9]
-			while isnumeric(line[c+9:c+9+l]):
-				velocity = line[c+9:c+9+l]
-				l += 1
-			noteAttribs.append(int(velocity))
-			
-			if int(velocity) > maxVelocity:
-				maxVelocity = int(velocity)
-			if int(velocity) < minVelocity:
-				minVelocity = int(velocity)
-		if line[c:c+5] == "time=":
-			l = 0
-			time = line[c+5]
-			while isnumeric(line[c+5:c+5+l]) and c+5+l <= len(line):
-				time = line[c+5:c+5+l]
-				l += 1
-			noteAttribs.append(int(time))
-		
-			if int(time) > maxTime:
-				maxTime = int(time)
-			if int(time) < minTime:
-				minTime = int(time)
-
-	noteAttribs.append(t)
-	t += 1
-	listOfNotes.append(noteAttribs)
-#print listOfNotes[t-1]
-
-for line in listOfNotes:
-	line[1] = float(line[1]-minNote)/maxNote
-	line[2] = float(line[2]-minVelocity)/maxVelocity
-	line[3] = float(line[3]-minTime)/maxTime
-	line[4] = float(line[4])/(t-1)
-	print line
-
-print "<", minNote, maxNote, ">"
-print "<", minVelocity, maxVelocity, ">"
-print "<", minTime, maxTime, ">"
-print "<", 0, t-1, ">"
+		stats = compute_stats(events)
+		save_stats(stats, midi_path.rsplit('.', 1)[0] + '.stats.json')
+
+	rows = normalize(events, stats)
+	np.save(midi_path.rsplit('.', 1)[0] + '.norm.npy', rows)
+
+	print(rows[:5])
+	print_stats(stats)
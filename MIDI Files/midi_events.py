@@ -0,0 +1,244 @@
+'''
+MIDI EVENTS
+Reads .mid files straight into a numpy structured array of note events, one row per
+note_on/note_off with its track, channel, note, velocity and timing. This replaces
+the Midi2Txt.py text dump + makeReady.py parsing: the file is parsed in one pass over
+its bytes, nothing goes through text.
+
+A note_on with velocity 0 is written as a note_off (that's what it means in MIDI).
+delta is the number of ticks since the previous note event of the same track (other
+messages in between are skipped, their time is carried over), tick is the absolute tick.
+
+Run with: python midi_events.py file.mid [file.mid ...]
+which writes file.npy next to every file.
+'''
+import collections
+import sys
+
+import numpy as np
+
+NOTE_OFF = 0
+NOTE_ON = 1
+
+EVENT_DTYPE = np.dtype([
+        ('track', np.uint16),
+        ('type', np.uint8), # NOTE_OFF or NOTE_ON
+        ('channel', np.uint8),
+        ('note', np.uint8),
+        ('velocity', np.uint8),
+        ('delta', np.uint32), # ticks since the previous note event of the track
+        ('tick', np.uint32), # absolute tick
+])
+
+#set_tempo changes, tempo in microseconds per beat
+TEMPO_DTYPE = np.dtype([('tick', np.uint32), ('tempo', np.uint32)])
+
+#the default tempo of a midi file (120 bpm)
+DEFAULT_TEMPO = 500000
+
+#events: EVENT_DTYPE array sorted by track, ticks_per_beat: from the header, tempos: TEMPO_DTYPE array
+Midi = collections.namedtuple('Midi', ['events', 'ticks_per_beat', 'tempos'])
+
+#number of data bytes that follow each channel message status (by its high nibble)
+DATA_BYTES = {0x8: 2, 0x9: 2, 0xA: 2, 0xB: 2, 0xC: 1, 0xD: 1, 0xE: 2}
+
+class MidiFormatError(ValueError):
+    pass
+
+def read_varlen(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+#appends the note events of one MTrk chunk to the columns, and the tempo changes to tempos
+def parse_track(data, pos, end, track, columns, tempos):
+    tick = 0
+    last_tick = 0
+    #the last channel status, which messages without a status byte reuse. Sequencers keep
+    #using it across meta and sysex events, so those don't reset it (mido reads them the same way)
+    running_status = 0
+
+    while pos < end:
+        delta, pos = read_varlen(data, pos)
+        tick += delta
+
+        byte = data[pos]
+        if byte >= 0x80:
+            status = byte
+            pos += 1
+            if status < 0xF0:
+                running_status = status
+        elif running_status == 0:
+            raise MidiFormatError('running status without a previous status byte')
+        else:
+            #running status, byte is already the first data byte
+            status = running_status
+
+        if status == 0xFF:
+            #meta message: type, length, data
+            meta_type = data[pos]
+            length, pos = read_varlen(data, pos + 1)
+            if meta_type == 0x51 and length == 3:
+                tempos.append((tick, (data[pos] << 16) | (data[pos+1] << 8) | data[pos+2]))
+            elif meta_type == 0x2F:
+                break
+            pos += length
+        elif status == 0xF0 or status == 0xF7:
+            length, pos = read_varlen(data, pos)
+            pos += length
+        else:
+            kind = status >> 4
+            if kind == 0x8 or kind == 0x9:
+                note = data[pos]
+                velocity = data[pos+1]
+
+                columns.append((track,
+                        NOTE_ON if kind == 0x9 and velocity > 0 else NOTE_OFF,
+                        status & 0x0F,
+                        note,
+                        velocity,
+                        tick - last_tick,
+                        tick))
+                last_tick = tick
+            pos += DATA_BYTES.get(kind, 0)
+
+def parse_midi(data):
+    data = memoryview(data)
+
+    if bytes(data[0:4]) != b'MThd':
+        raise MidiFormatError('not a midi file')
+
+    header_length = int.from_bytes(data[4:8], 'big')
+    num_tracks = int.from_bytes(data[10:12], 'big')
+    ticks_per_beat = int.from_bytes(data[12:14], 'big')
+
+    rows = []
+    tempos = []
+    pos = 8 + header_length
+    track = 0
+
+    while pos + 8 <= len(data) and track < num_tracks:
+        chunk_type = bytes(data[pos:pos+4])
+        length = int.from_bytes(data[pos+4:pos+8], 'big')
+        pos += 8
+
+        #unknown chunk types are skipped, as the spec says
+        if chunk_type == b'MTrk':
+            parse_track(data, pos, min(pos + length, len(data)), track, rows, tempos)
+            track += 1
+        pos += length
+
+    events = np.array(rows, dtype=EVENT_DTYPE)
+
+    tempos = np.array(sorted(tempos), dtype=TEMPO_DTYPE)
+    if len(tempos) == 0 or tempos['tick'][0] != 0:
+        tempos = np.concatenate([np.array([(0, DEFAULT_TEMPO)], dtype=TEMPO_DTYPE), tempos])
+
+    return Midi(events, ticks_per_beat, tempos)
+
+#seconds of every tick, going through the tempo changes (a TEMPO_DTYPE array) of the file
+def tick_seconds(ticks, ticks_per_beat, tempos):
+    tempo_ticks = tempos['tick'].astype(np.float64)
+    seconds_per_tick = tempos['tempo'] / 1e6 / ticks_per_beat
+
+    #time at which every tempo change starts
+    starts = np.concatenate([[0.0], np.cumsum(np.diff(tempo_ticks) * seconds_per_tick[:-1])])
+
+    segment = np.searchsorted(tempo_ticks, ticks, side='right') - 1
+    return starts[segment] + (ticks - tempo_ticks[segment]) * seconds_per_tick[segment]
+
+def read_midi(path):
+    with open(path, 'rb') as f:
+        return parse_midi(f.read())
+
+#lazily converts any number of files, yields (path, Midi)
+def iter_midi(paths):
+    for path in paths:
+        yield path, read_midi(path)
+
+'''
+WRITING
+The reverse of parse_midi(): every track is encoded in one pass of numpy operations over
+the whole event array (delta times as variable length quantities, then the fixed size
+messages), no per note calls. The file is format 1 with the tempo changes in track 0.
+'''
+END_OF_TRACK = b'\x00\xFF\x2F\x00'
+
+#longest message written (a set_tempo: FF 51 03 tt tt tt)
+MESSAGE_WIDTH = 6
+
+#one MTrk chunk. ticks: absolute tick of every message (sorted), messages: (n, MESSAGE_WIDTH)
+#uint8 rows of which the first widths[i] bytes are used
+def pack_track(ticks, messages, widths):
+    delta = np.diff(ticks.astype(np.int64), prepend=0)
+
+    #a variable length quantity holds 7 bits per byte, most significant byte first
+    num_bytes = 1 + sum((delta >= 1 << (7 * j)).astype(np.int64) for j in range(1, 5))
+    lengths = num_bytes + widths
+    starts = np.cumsum(lengths) - lengths
+
+    data = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for j in range(5):
+        #byte j counted from the end, all but the last byte have the continuation bit set
+        used = num_bytes > j
+        data[starts[used] + num_bytes[used] - 1 - j] = ((delta[used] >> (7 * j)) & 0x7F) | (0x80 if j else 0)
+
+    columns = np.arange(MESSAGE_WIDTH)
+    used = columns < widths[:, np.newaxis]
+    data[((starts + num_bytes)[:, np.newaxis] + columns)[used]] = messages[used]
+
+    body = data.tobytes() + END_OF_TRACK
+    return b'MTrk' + len(body).to_bytes(4, 'big') + body
+
+def encode_midi(midi):
+    events = midi.events[np.lexsort((midi.events['tick'], midi.events['track']))]
+
+    note_messages = np.zeros((len(events), MESSAGE_WIDTH), dtype=np.uint8)
+    note_messages[:, 0] = np.where(events['type'] == NOTE_ON, 0x90, 0x80) | (events['channel'] & 0x0F)
+    note_messages[:, 1] = events['note'] & 0x7F
+    note_messages[:, 2] = events['velocity'] & 0x7F
+
+    tempos = midi.tempos
+    tempo_messages = np.zeros((len(tempos), MESSAGE_WIDTH), dtype=np.uint8)
+    tempo_messages[:, :3] = (0xFF, 0x51, 0x03)
+    for j in range(3):
+        tempo_messages[:, 3 + j] = (tempos['tempo'] >> (8 * (2 - j))) & 0xFF
+
+    num_tracks = int(events['track'].max()) + 1 if len(events) else 1
+    bounds = np.searchsorted(events['track'], np.arange(num_tracks + 1))
+
+    chunks = []
+    for track in range(num_tracks):
+        ticks = events['tick'][bounds[track]:bounds[track+1]]
+        messages = note_messages[bounds[track]:bounds[track+1]]
+        widths = np.full(len(ticks), 3)
+
+        if track == 0:
+            #tempo changes go before the notes of the same tick
+            ticks = np.concatenate([tempos['tick'], ticks])
+            messages = np.concatenate([tempo_messages, messages])
+            widths = np.concatenate([np.full(len(tempos), 6), widths])
+
+            order = np.argsort(ticks, kind='stable')
+            ticks, messages, widths = ticks[order], messages[order], widths[order]
+
+        chunks.append(pack_track(ticks, messages, widths))
+
+    header = b'MThd' + (6).to_bytes(4, 'big') + (1).to_bytes(2, 'big') + \
+            num_tracks.to_bytes(2, 'big') + int(midi.ticks_per_beat).to_bytes(2, 'big')
+    return header + b''.join(chunks)
+
+def write_midi(path, midi):
+    with open(path, 'wb') as f:
+        f.write(encode_midi(midi))
+    return path
+
+if __name__ == '__main__':
+    for path, midi in iter_midi(sys.argv[1:]):
+        out = path.rsplit('.', 1)[0] + '.npy'
+        np.save(out, midi.events)
+        print('{}: {} note events -> {}'.format(path, len(midi.events), out))
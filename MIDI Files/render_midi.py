@@ -0,0 +1,230 @@
+'''
+MIDI RENDERING
+Renders .mid files to audio offline, without a sound card and faster than real time
+(this replaces fluidsynthtest.sh, which played through alsa). Two synths:
+ - the built in one: every note is a few harmonics with an attack/decay/release envelope,
+   written straight into a numpy buffer. Channel 10 (drums) is left out.
+ - a soundfont, when one is given, through the fluidsynth library (pip install
+   pyfluidsynth) running in this process with no audio driver. Only note events are kept
+   by midi_events.py, so every channel plays program 0 (drums on channel 10).
+The result is a (samples, channels) float32 array in [-1, 1], saved as a 16 bit .wav (or
+as .npy). Many files are rendered side by side on a process pool.
+
+Run with: python render_midi.py <midi file or directory> <output directory> [soundfont.sf2]
+'''
+import os
+import sys
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import midi_events
+
+SAMPLE_RATE = 44100
+
+#built in synth: (harmonic, amplitude) pairs, attack in seconds, decay rate per second
+#while the note is held, release time after the note off
+HARMONICS = [(1, 1.0), (2, 0.5), (3, 0.25), (4, 0.125)]
+#one period of the harmonics, looked up instead of computing the sines of every note
+TABLE_SIZE = 4096
+ATTACK = 0.005
+DECAY = 1.5
+RELEASE = 0.2
+
+#notes without a note off are cut after this many seconds
+MAX_NOTE_LENGTH = 8.0
+
+DRUM_CHANNEL = 9
+
+#(channel, note, velocity, start seconds, end seconds) of every note, each note on paired
+#with the first note off of the same channel and note after it
+def note_spans(midi):
+    events = midi.events
+    seconds = midi_events.tick_seconds(events['tick'], midi.ticks_per_beat, midi.tempos)
+
+    on = events['type'] == midi_events.NOTE_ON
+    key = events['channel'].astype(np.int64) * 128 + events['note']
+
+    #one sortable number per event: key first, then time
+    position = key * (1 << 33) + events['tick']
+    off_order = np.argsort(position[~on], kind='stable')
+    off_position = position[~on][off_order]
+    off_seconds = seconds[~on][off_order]
+
+    #an off at the same tick as the on belongs to the note before
+    match = np.searchsorted(off_position, position[on], side='right')
+    found = match < len(off_position)
+    found[found] = (off_position[match[found]] >> 33) == key[on][found]
+
+    start = seconds[on]
+    end = np.where(found, off_seconds[np.minimum(match, len(off_seconds) - 1)], start + MAX_NOTE_LENGTH)
+    end = np.minimum(end, start + MAX_NOTE_LENGTH)
+
+    return events['channel'][on], events['note'][on], events['velocity'][on], start, end
+
+def render_builtin(midi, sample_rate=SAMPLE_RATE):
+    channel, note, velocity, start, end = note_spans(midi)
+    keep = channel != DRUM_CHANNEL
+    note, velocity, start, end = note[keep], velocity[keep], start[keep], end[keep]
+
+    length = int(np.ceil(((end.max() if len(end) else 0) + RELEASE) * sample_rate)) + 1
+    audio = np.zeros(length, dtype=np.float32)
+
+    frequency = 440.0 * 2.0 ** ((note.astype(np.float64) - 69) / 12.0)
+    first = np.rint(start * sample_rate).astype(np.int64)
+    held = np.maximum(np.rint((end - start) * sample_rate).astype(np.int64), 1)
+    release = int(RELEASE * sample_rate)
+    amplitude = (velocity / 127.0) * 0.2
+
+    period = np.arange(TABLE_SIZE) / float(TABLE_SIZE)
+    table = sum(a * np.sin(2 * np.pi * h * period) for h, a in HARMONICS).astype(np.float32)
+
+    #one time axis long enough for every note, sliced per note
+    samples = np.arange(int(held.max()) + release if len(held) else 0)
+    t = samples / float(sample_rate)
+    attack = np.minimum(t / ATTACK, 1.0)
+    decay = np.exp(-DECAY * t)
+    fade = np.linspace(1.0, 0.0, release, endpoint=False)
+
+    for i in range(len(note)):
+        n = held[i] + release
+        step = frequency[i] * TABLE_SIZE / sample_rate
+        tone = table[(samples[:n] * step).astype(np.int64) & (TABLE_SIZE - 1)]
+
+        envelope = attack[:n] * decay[:n]
+        envelope[held[i]:] = envelope[held[i] - 1] * fade
+
+        audio[first[i]:first[i] + n] += amplitude[i] * tone * envelope
+
+    return limit(audio[:, np.newaxis])
+
+def render_soundfont(midi, soundfont, sample_rate=SAMPLE_RATE):
+    import fluidsynth
+
+    #no start() call, so no audio driver is opened: the samples are pulled with get_samples()
+    synth = fluidsynth.Synth(samplerate=float(sample_rate))
+    sfid = synth.sfload(soundfont)
+    if sfid < 0:
+        raise IOError('could not load soundfont {}'.format(soundfont))
+    for channel in range(16):
+        synth.program_select(channel, sfid, 128 if channel == DRUM_CHANNEL else 0, 0)
+
+    events = midi.events[np.argsort(midi.events['tick'], kind='stable')]
+    sample = np.rint(midi_events.tick_seconds(events['tick'], midi.ticks_per_beat, midi.tempos)
+            * sample_rate).astype(np.int64)
+
+    pieces = []
+    done = 0
+    for event, at in zip(events.tolist(), sample.tolist()):
+        if at > done:
+            pieces.append(synth.get_samples(at - done))
+            done = at
+
+        _, kind, channel, note, velocity, _, _ = event
+        if kind == midi_events.NOTE_ON:
+            synth.noteon(channel, note, velocity)
+        else:
+            synth.noteoff(channel, note)
+
+    #let the last notes ring out
+    pieces.append(synth.get_samples(int(RELEASE * 5 * sample_rate)))
+    synth.delete()
+
+    #get_samples() gives interleaved stereo int16
+    audio = np.concatenate(pieces).astype(np.float32).reshape(-1, 2) / 32768.0
+    return limit(audio)
+
+#scales the audio down if it would clip
+def limit(audio):
+    peak = np.abs(audio).max() if audio.size else 0.0
+    if peak > 1.0:
+        audio /= peak
+    return audio
+
+def render(midi, soundfont=None, sample_rate=SAMPLE_RATE):
+    if soundfont:
+        return render_soundfont(midi, soundfont, sample_rate)
+    return render_builtin(midi, sample_rate)
+
+def write_wav(path, audio, sample_rate=SAMPLE_RATE):
+    pcm = np.clip(np.rint(audio * 32767.0), -32768, 32767).astype('<i2')
+
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(pcm.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(pcm.tobytes())
+
+#worker: render one file to out_path (.wav or .npy), returns (out_path, seconds of audio, error)
+def render_file(path, out_path, soundfont=None, sample_rate=SAMPLE_RATE):
+    try:
+        audio = render(midi_events.read_midi(path), soundfont, sample_rate)
+
+        if out_path.endswith('.npy'):
+            np.save(out_path, audio)
+        else:
+            write_wav(out_path, audio, sample_rate)
+
+        return out_path, len(audio) / float(sample_rate), None
+    except Exception as e:
+        return out_path, 0.0, '{}: {}'.format(type(e).__name__, e)
+
+#the output of every path mirrors where it sits under root (by default the directory all of
+#the paths share), so files with the same name in different directories don't overwrite each other
+def output_paths(paths, out_dir, root=None, extension='.wav'):
+    if root is None:
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+
+    out_paths = [os.path.join(out_dir, os.path.splitext(os.path.relpath(os.path.abspath(path), root))[0] + extension)
+            for path in paths]
+
+    #song.mid and song.midi still end up on the same output
+    seen = {}
+    for path, out_path in zip(paths, out_paths):
+        if out_path in seen:
+            raise ValueError('{} and {} would both render to {}'.format(seen[out_path], path, out_path))
+        seen[out_path] = path
+    return out_paths
+
+def render_files(paths, out_dir, soundfont=None, workers=None, extension='.wav', sample_rate=SAMPLE_RATE,
+        root=None):
+    start = time.time()
+    if not paths:
+        return []
+
+    out_paths = output_paths(paths, out_dir, root, extension)
+    for out_path in out_paths:
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+    with ProcessPoolExecutor(workers) as pool:
+        results = list(pool.map(render_file, paths, out_paths,
+                [soundfont] * len(paths), [sample_rate] * len(paths)))
+
+    audio_seconds = 0.0
+    for path, (out_path, seconds, error) in zip(paths, results):
+        if error is not None:
+            print('Skipping {} ({})'.format(path, error))
+        audio_seconds += seconds
+
+    elapsed = time.time() - start
+    print('Rendered {:.1f} secs of audio from {} files in {:.1f} secs ({:.0f}x real time)'.format(
+            audio_seconds, len(paths), elapsed, audio_seconds / max(elapsed, 1e-9)))
+    return results
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('usage: python render_midi.py <midi file or directory> <output directory> [soundfont.sf2]')
+        sys.exit(1)
+
+    source = sys.argv[1]
+    if os.path.isdir(source):
+        import ingest_midi
+        paths = ingest_midi.find_midi_files(source)
+        root = os.path.abspath(source)
+    else:
+        paths = [source]
+        root = None
+
+    render_files(paths, sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None, root=root)
@@ -19,39 +19,29 @@ for i, pitch in enumerate(degrees):
 with open("major-scale.mid", "wb") as output_file:
     MyMIDI.writeFile(output_file)
 '''
-import pydub 
 import numpy as np
+import os
+import sys
 
-def read(f, normalized=False):
-    """MP3 to numpy array"""
-    a = pydub.AudioSegment.from_mp3(f)
-    y = np.array(a.get_array_of_samples())
-    if a.channels == 2:
-        y = y.reshape((-1, 2))
-    if normalized:
-        return a.frame_rate, np.float32(y) / 2**15
-    else:
-        return a.frame_rate, y
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import audio_export
+import audio_io
+
+def read(f, normalized=False, channel=None):
+    """MP3 or WAV to numpy array (see audio_io.py)"""
+    return audio_io.load_audio(f, channel=channel, normalized=normalized)
 
 def write(f, sr, x, normalized=False):
-    """numpy array to MP3"""
-    channels = 2 if (x.ndim == 2 and x.shape[1] == 2) else 1
-    if normalized:  # normalized array - each item should be a float in [-1, 1)
-        y = np.int16(x * 2 ** 15)
-    else:
-        y = np.int16(x)
-    song = pydub.AudioSegment(y.tobytes(), frame_rate=sr, sample_width=2, channels=channels)
-    song.export(f, format="mp3", bitrate="320k")
-
-sr, x = read('songtest.mp3')
-arr = []
-for i in range(0, np.size(x)/2):
-    arr.append(x[i])
+    """numpy array to MP3, WAV or FLAC (by extension) in the background, returns a future (see audio_export.py)"""
+    return audio_export.get_exporter().submit(f, sr, x, normalized)
+
+#first channel, as a view of the decoded samples
+sr, x = read('songtest.mp3', channel=0)
 
 import pywt
 import pywt.data
 import matplotlib.pyplot as plt
-cA, cD = pywt.dwt(arr, 'db1')
+cA, cD = pywt.dwt(x, 'db1')
 
 
 
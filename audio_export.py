@@ -0,0 +1,140 @@
+'''
+AUDIO EXPORT
+Writes numpy audio to .wav, .flac or .mp3 in the background. AudioExporter queues the
+arrays on a thread pool and hands back a future for every file, so a script can keep
+generating while earlier pieces are still being encoded, and a whole batch is encoded by
+several encoders at once instead of one after the other.
+
+A .wav is written with the wave module, .flac and .mp3 are piped into ffmpeg (the encoder
+pydub uses as well). Both take the int16 samples through a memoryview, so the samples are
+never copied into a bytes object first. The encoding happens in ffmpeg or in wave's
+C code, so threads are enough to keep every worker busy. Files are written under a
+temporary name and renamed when complete.
+'''
+import os
+import subprocess
+import sys
+import uuid
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+EXPORT_FORMATS = ('wav', 'flac', 'mp3')
+MP3_BITRATE = '320k'
+
+#ffmpeg output options of every format it encodes
+FFMPEG_OPTIONS = {
+    'flac': ['-f', 'flac'],
+    'mp3': ['-f', 'mp3', '-b:a', MP3_BITRATE],
+}
+
+#samples as a contiguous (frames, channels) int16 array. normalized samples are floats in [-1, 1)
+def to_pcm16(x, normalized=False):
+    x = np.asarray(x)
+    x = x.reshape(len(x), -1)
+
+    if normalized:
+        x = np.clip(np.rint(x * 2 ** 15), -2 ** 15, 2 ** 15 - 1)
+    return np.ascontiguousarray(x, dtype='<i2')
+
+def write_wav(path, rate, pcm):
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(pcm.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(memoryview(pcm).cast('B'))
+
+def write_ffmpeg(path, rate, pcm, format):
+    command = ['ffmpeg', '-loglevel', 'error', '-y',
+            '-f', 's16le', '-ar', str(rate), '-ac', str(pcm.shape[1]), '-i', 'pipe:0']
+    command += FFMPEG_OPTIONS[format] + [path]
+
+    process = subprocess.run(command, input=memoryview(pcm).cast('B'), stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise IOError('ffmpeg failed on {}: {}'.format(path, process.stderr.decode(errors='replace').strip()))
+
+#format of a path from its extension
+def export_format(path):
+    format = os.path.splitext(path)[1][1:].lower()
+    if format not in EXPORT_FORMATS:
+        raise ValueError('can only export {}, not {}'.format(EXPORT_FORMATS, path))
+    return format
+
+#worker: encodes one array to path and returns path. x can also be the int16 samples of
+#to_pcm16() with normalized=False, which are used as they are
+def export(path, rate, x, normalized=False, format=None):
+    format = format or export_format(path)
+    pcm = to_pcm16(x, normalized)
+
+    #the temporary file keeps the extension, ffmpeg and players look at it. It's unique to the
+    #call, so exports to the same path at once don't move each other's files
+    root, ext = os.path.splitext(path)
+    tmp_path = '{}.{}.{}.tmp{}'.format(root, os.getpid(), uuid.uuid4().hex, ext)
+
+    try:
+        if format == 'wav':
+            write_wav(tmp_path, rate, pcm)
+        else:
+            write_ffmpeg(tmp_path, rate, pcm, format)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+    return path
+
+class AudioExporter(object):
+    def __init__(self, workers=None):
+        self.pool = ThreadPoolExecutor(workers or os.cpu_count())
+
+    #queues one file, the future gives back its path (or raises what went wrong). The samples
+    #are converted right away, so the caller can reuse x as soon as submit() returns. The
+    #conversion is already a new array unless x is contiguous int16, which is copied
+    def submit(self, path, rate, x, normalized=False, format=None):
+        format = format or export_format(path)
+
+        pcm = to_pcm16(x, normalized)
+        if np.shares_memory(pcm, x):
+            pcm = pcm.copy()
+        return self.pool.submit(export, path, rate, pcm, False, format)
+
+    #queues every (path, rate, samples) of a batch, returns their futures in the same order
+    def submit_batch(self, items, normalized=False, format=None):
+        return [self.submit(path, rate, x, normalized, format) for path, rate, x in items]
+
+    #waits for everything queued to be written
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+exporter = None
+
+#the exporter shared by the scripts, created on first use
+def get_exporter():
+    global exporter
+    if exporter is None:
+        exporter = AudioExporter()
+    return exporter
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('usage: python audio_export.py <out format> <audio file> [<audio file> ...]')
+        sys.exit(1)
+
+    import audio_io
+
+    format = sys.argv[1]
+    with AudioExporter() as exporter:
+        futures = []
+        for path in sys.argv[2:]:
+            rate, x = audio_io.load_audio(path)
+            futures.append(exporter.submit(os.path.splitext(path)[0] + '.' + format, rate, x))
+
+        for future in futures:
+            print('Wrote {}'.format(future.result()))
@@ -0,0 +1,195 @@
+'''
+AUDIO LOADING
+One loader for the .wav and .mp3 files the wavelet scripts work on. The samples come back
+as numpy views instead of being copied around:
+ - a .wav is memory mapped by scipy, so loading it reads nothing until the samples are used
+ - an .mp3 is decoded by pydub (ffmpeg) and its raw bytes are viewed as an array in place
+   of going through get_array_of_samples()
+Selecting a channel gives a strided view of that column, and only normalized=True (float32
+in [-1, 1]) makes a copy. Both can be passed to pywt directly.
+
+Decoding an .mp3 is slow, so the decoded samples are kept in PCM_CACHE_DIR (see the PCM
+CACHE section below) and memory mapped from there the next time.
+'''
+import glob
+import hashlib
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.io.wavfile as wavfile
+
+#numpy dtype of pydub's sample widths (in bytes)
+SAMPLE_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+#samples as a (frames, channels) view, whatever the number of channels
+def as_frames(samples):
+    return samples.reshape(len(samples), -1)
+
+def load_wav(path, mmap=True):
+    rate, samples = wavfile.read(path, mmap=mmap)
+    return rate, as_frames(samples)
+
+def load_mp3(path):
+    import pydub
+
+    segment = pydub.AudioSegment.from_mp3(path)
+    samples = np.frombuffer(segment.raw_data, dtype=SAMPLE_DTYPES[segment.sample_width])
+    return segment.frame_rate, samples.reshape(-1, segment.channels)
+
+#integer samples to float32 in [-1, 1]. 8 bit .wav files are unsigned, with silence at 128
+def normalize(samples):
+    if samples.dtype.kind == 'f':
+        return samples.astype(np.float32, copy=False)
+    if samples.dtype == np.uint8:
+        return (samples.astype(np.float32) - 128.0) / 128.0
+    return samples.astype(np.float32) / float(2 ** (8 * samples.dtype.itemsize - 1))
+
+'''
+PCM CACHE
+Every decoded .mp3 is saved as <sha1 of the mp3>-<rate>hz.npy in PCM_CACHE_DIR, so it's
+only decoded once whatever its name or location, and later loads are a memory map of the
+.npy. Loading a cached file bumps its mtime, and when the cache grows over PCM_CACHE_SIZE
+bytes the least recently used files are removed. decode_all() fills the cache for many
+files at once on a process pool.
+'''
+PCM_CACHE_DIR = './pcm_cache'
+PCM_CACHE_SIZE = 2 * 1024 ** 3
+
+def hash_file(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+#path of the cached samples of an mp3 with this hash, None if it isn't cached
+def cached_pcm(sha1, cache_dir=PCM_CACHE_DIR):
+    paths = glob.glob(os.path.join(cache_dir, sha1 + '-*hz.npy'))
+    return paths[0] if paths else None
+
+#decodes the mp3 into the cache unless it's there already, returns the cached .npy
+def cache_mp3(path, cache_dir=PCM_CACHE_DIR, sha1=None):
+    sha1 = sha1 or hash_file(path)
+    cached = cached_pcm(sha1, cache_dir)
+    if cached is not None:
+        return cached
+
+    rate, samples = load_mp3(path)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    cached = os.path.join(cache_dir, '{}-{}hz.npy'.format(sha1, rate))
+    #saved under a name of its own first, so a half written file is never picked up and
+    #workers decoding the same content at once don't move each other's files
+    tmp_path = '{}.{}.{}.tmp.npy'.format(cached, os.getpid(), uuid.uuid4().hex)
+    np.save(tmp_path, samples)
+
+    #another worker got there first with the same samples
+    if os.path.exists(cached):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, cached)
+    return cached
+
+#removes the least recently used files until the cache fits in max_bytes, never the ones in keep
+def evict(cache_dir=PCM_CACHE_DIR, max_bytes=PCM_CACHE_SIZE, keep=()):
+    keep = set(os.path.abspath(path) for path in keep)
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, '*hz.npy')):
+        if os.path.abspath(path) in keep:
+            continue
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries) + sum(os.path.getsize(path) for path in keep if os.path.exists(path))
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+
+#(rate, samples) of an mp3 through the cache, the samples memory mapped from the .npy
+def load_mp3_cached(path, cache_dir=PCM_CACHE_DIR, max_bytes=PCM_CACHE_SIZE):
+    sha1 = hash_file(path)
+    cached = cached_pcm(sha1, cache_dir)
+
+    if cached is None:
+        cached = cache_mp3(path, cache_dir, sha1)
+        #the file being loaded stays, even when it's larger than max_bytes on its own
+        evict(cache_dir, max_bytes, keep=[cached])
+    else:
+        #marks it as recently used
+        os.utime(cached)
+
+    rate = int(os.path.basename(cached).rsplit('-', 1)[1][:-len('hz.npy')])
+    return rate, np.load(cached, mmap_mode='r')
+
+#decodes every mp3 into the cache on a process pool, then evicts down to max_bytes. The files
+#just decoded are kept, even when together they don't fit
+def decode_all(paths, cache_dir=PCM_CACHE_DIR, workers=None, max_bytes=PCM_CACHE_SIZE):
+    start = time.time()
+
+    with ProcessPoolExecutor(workers) as pool:
+        cached = list(pool.map(cache_mp3, paths, [cache_dir] * len(paths)))
+
+    evict(cache_dir, max_bytes, keep=cached)
+    print('Decoded {} files into {} in {:.1f} secs'.format(len(paths), cache_dir, time.time() - start))
+    return cached
+
+#returns (rate, samples). samples is (frames, channels), or (frames,) when a channel is picked.
+#mp3s go through the PCM cache unless cache_dir is None
+def load_audio(path, channel=None, normalized=False, mmap=True, cache_dir=PCM_CACHE_DIR):
+    if path.lower().endswith('.mp3'):
+        if cache_dir is None:
+            rate, samples = load_mp3(path)
+        else:
+            rate, samples = load_mp3_cached(path, cache_dir)
+    else:
+        rate, samples = load_wav(path, mmap)
+
+    if channel is not None:
+        samples = samples[:, channel]
+    if normalized:
+        samples = normalize(samples)
+
+    return rate, samples
+
+'''
+BLOCK READING
+iter_blocks() goes through a file a block of frames at a time. A .wav stays memory mapped,
+so only the block being worked on is ever read into memory (and converted, when
+normalized), however long the recording is.
+'''
+BLOCK_FRAMES = 1 << 16
+
+#number of frames of a file. A .wav is only mapped, its samples aren't read
+def count_frames(path):
+    rate, samples = load_audio(path)
+    return len(samples)
+
+#yields (frames, channels) blocks, or (frames,) blocks when a channel is picked. The last
+#block is shorter
+def iter_blocks(path, block_frames=BLOCK_FRAMES, channel=None, normalized=False):
+    rate, samples = load_audio(path, channel=channel)
+
+    for start in range(0, len(samples), block_frames):
+        block = np.array(samples[start:start + block_frames])
+        if normalized:
+            block = normalize(block)
+        yield block
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python audio_io.py <mp3 file or directory> [workers]')
+        sys.exit(1)
+
+    source = sys.argv[1]
+    if os.path.isdir(source):
+        paths = sorted(glob.glob(os.path.join(source, '**', '*.mp3'), recursive=True))
+    else:
+        paths = [source]
+
+    decode_all(paths, workers=int(sys.argv[2]) if len(sys.argv) > 2 else None)
@@ -0,0 +1,174 @@
+'''
+MIDI TOKENIZER
+Turns the note events of midi_events.py into the event vocabulary of Performance RNN, so
+the Transformer in model.py can be trained on midi instead of the TED sentences:
+
+    0                     padding (as with the subword tokenizers)
+    NOTE_ON_OFFSET + p    note on, pitch p (128 ids)
+    NOTE_OFF_OFFSET + p   note off, pitch p (128 ids)
+    VELOCITY_OFFSET + b   the following note ons have velocity bin b (VELOCITY_BINS ids)
+    TIME_SHIFT_OFFSET + s move time forward by s+1 steps of TIME_STEP_MS (MAX_SHIFT_STEPS ids)
+
+MidiTokenizer has the same vocab_size as the subword tokenizers, so the start token is
+vocab_size and the end token vocab_size + 1 as everywhere in model.py. Encoding and
+decoding work on whole numpy arrays at once, nothing loops over the tokens in python.
+'''
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MIDI Files'))
+import midi_events
+
+NUM_PITCHES = 128
+VELOCITY_BINS = 32
+TIME_STEP_MS = 10
+#the longest shift a single token can hold (1 second), longer gaps take several tokens
+MAX_SHIFT_STEPS = 100
+
+NOTE_ON_OFFSET = 1
+NOTE_OFF_OFFSET = NOTE_ON_OFFSET + NUM_PITCHES
+VELOCITY_OFFSET = NOTE_OFF_OFFSET + NUM_PITCHES
+TIME_SHIFT_OFFSET = VELOCITY_OFFSET + VELOCITY_BINS
+VOCAB_SIZE = TIME_SHIFT_OFFSET + MAX_SHIFT_STEPS
+
+#the timing decoded events are written with
+DECODE_TICKS_PER_BEAT = 480
+
+class MidiTokenizer(object):
+    def __init__(self):
+        self.vocab_size = VOCAB_SIZE
+
+    #ids of a Midi (see midi_events.py) as an int64 array, all tracks merged by time
+    def encode_array(self, midi):
+        events = midi.events[np.argsort(midi.events['tick'], kind='stable')]
+        if len(events) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        steps = np.rint(midi_events.tick_seconds(events['tick'], midi.ticks_per_beat, midi.tempos)
+                * 1000.0 / TIME_STEP_MS).astype(np.int64)
+        shift = np.diff(steps, prepend=0)
+
+        #a shift takes ceil(shift / MAX_SHIFT_STEPS) tokens
+        num_shifts = -(-shift // MAX_SHIFT_STEPS)
+
+        note_on = events['type'] == midi_events.NOTE_ON
+        velocity_bin = events['velocity'].astype(np.int64) * VELOCITY_BINS // 128
+
+        #a velocity token only goes before the note ons whose bin differs from the previous note on
+        on_bins = velocity_bin[note_on]
+        new_velocity = np.zeros(len(events), dtype=bool)
+        new_velocity[note_on] = on_bins != np.concatenate([[-1], on_bins[:-1]])
+
+        counts = num_shifts + new_velocity + 1
+        starts = np.cumsum(counts) - counts
+        ids = np.empty(counts.sum(), dtype=np.int64)
+
+        #shift tokens: MAX_SHIFT_STEPS each, the last one holds the remainder
+        owner = np.repeat(np.arange(len(events)), num_shifts)
+        position = np.arange(len(owner)) - np.repeat(np.cumsum(num_shifts) - num_shifts, num_shifts)
+        last = position == num_shifts[owner] - 1
+        remainder = shift[owner] - (num_shifts[owner] - 1) * MAX_SHIFT_STEPS
+        ids[starts[owner] + position] = TIME_SHIFT_OFFSET - 1 + np.where(last, remainder, MAX_SHIFT_STEPS)
+
+        ids[(starts + num_shifts)[new_velocity]] = VELOCITY_OFFSET + velocity_bin[new_velocity]
+
+        pitch = events['note'].astype(np.int64)
+        ids[starts + counts - 1] = np.where(note_on, NOTE_ON_OFFSET, NOTE_OFF_OFFSET) + pitch
+
+        return ids
+
+    #same as SubwordTextEncoder.encode(), a list of ids
+    def encode(self, midi):
+        return self.encode_array(midi).tolist()
+
+    #ids back to a Midi with DECODE_TICKS_PER_BEAT and the default tempo. Padding, start,
+    #end and any other id outside of the vocabulary are ignored
+    def decode(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        ids = ids[(ids >= NOTE_ON_OFFSET) & (ids < VOCAB_SIZE)]
+
+        is_shift = ids >= TIME_SHIFT_OFFSET
+        is_velocity = (ids >= VELOCITY_OFFSET) & ~is_shift
+        is_note = ids < VELOCITY_OFFSET
+
+        step = np.cumsum(np.where(is_shift, ids - TIME_SHIFT_OFFSET + 1, 0))
+
+        #the velocity in effect at every token, a velocity token holds until the next one
+        last_velocity = np.maximum.accumulate(np.where(is_velocity, np.arange(len(ids)), -1)) if len(ids) else ids
+        velocity_bin = np.where(last_velocity >= 0, ids[last_velocity] - VELOCITY_OFFSET, VELOCITY_BINS // 2)
+        velocity = np.clip((velocity_bin * 128 + 64) // VELOCITY_BINS, 1, 127)
+
+        note_ids = ids[is_note]
+        note_on = note_ids < NOTE_OFF_OFFSET
+
+        ticks_per_ms = DECODE_TICKS_PER_BEAT * 1000.0 / midi_events.DEFAULT_TEMPO
+        tick = np.rint(step[is_note] * TIME_STEP_MS * ticks_per_ms).astype(np.int64)
+
+        events = np.zeros(len(note_ids), dtype=midi_events.EVENT_DTYPE)
+        events['type'] = np.where(note_on, midi_events.NOTE_ON, midi_events.NOTE_OFF)
+        events['note'] = np.where(note_on, note_ids - NOTE_ON_OFFSET, note_ids - NOTE_OFF_OFFSET)
+        events['velocity'] = np.where(note_on, velocity[is_note], 0)
+        events['tick'] = tick
+        events['delta'] = np.diff(tick, prepend=0)
+
+        tempos = np.array([(0, midi_events.DEFAULT_TEMPO)], dtype=midi_events.TEMPO_DTYPE)
+        return midi_events.Midi(events, DECODE_TICKS_PER_BEAT, tempos)
+
+#start + window + end, for every complete window of a token array
+def split_windows(ids, window, tokenizer):
+    count = len(ids) // window
+    windows = ids[:count * window].reshape(count, window)
+
+    return np.concatenate([np.full((count, 1), tokenizer.vocab_size),
+            windows,
+            np.full((count, 1), tokenizer.vocab_size + 1)], axis=1)
+
+#(inp, tar) pairs of an ingested corpus (see MIDI Files/ingest_midi.py), the target being
+#the window that follows the input in the same piece. Every validation_every-th file goes
+#to validation. Returns ((train_inp, train_tar), (val_inp, val_tar)) int64 arrays
+def corpus_windows(store_dir, tokenizer, window, validation_every=10):
+    import ingest_midi
+
+    files, index, shards = ingest_midi.load_corpus(store_dir)
+    pairs = ([], []), ([], [])
+
+    #the index rows of every file, grouped once instead of scanning the index per file
+    file_rows = dict(zip(*ingest_midi.group_rows(index, 'file')))
+
+    for file_id, entry in enumerate(files):
+        tempos = np.array([tuple(t) for t in entry['tempos']], dtype=midi_events.TEMPO_DTYPE)
+        rows = file_rows.get(file_id, index[:0])
+        midi = midi_events.Midi(ingest_midi.rows_events(shards, rows), entry['ticks_per_beat'], tempos)
+
+        windows = split_windows(tokenizer.encode_array(midi), window, tokenizer)
+        inp, tar = pairs[file_id % validation_every == 0]
+        inp.append(windows[:-1])
+        tar.append(windows[1:])
+
+    empty = np.zeros((0, window + 2), dtype=np.int64)
+    return tuple((np.concatenate(inp + [empty]), np.concatenate(tar + [empty])) for inp, tar in pairs)
+
+#worker: decode one id array and write it as a .mid file
+def write_ids(ids, path):
+    return midi_events.write_midi(path, MidiTokenizer().decode(ids))
+
+#writes every generated id array of a batch to the path at the same position. The encoding
+#is numpy and the writes are I/O, so a thread pool is enough, but any executor can be
+#passed in (a ProcessPoolExecutor works as well, write_ids pickles)
+def write_batch(id_arrays, paths, workers=None, executor=None):
+    if executor is not None:
+        return list(executor.map(write_ids, id_arrays, paths))
+
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(write_ids, id_arrays, paths))
+
+if __name__ == '__main__':
+    tokenizer = MidiTokenizer()
+    for path in sys.argv[1:]:
+        midi = midi_events.read_midi(path)
+        ids = tokenizer.encode_array(midi)
+        print('{}: {} note events -> {} tokens (vocab size {})'.format(
+                path, len(midi.events), len(ids), tokenizer.vocab_size))
@@ -2,47 +2,69 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 #import tensorflow.compat.v1 as tf
 import tensorflow as tf
-import tensorflow_datasets as tfds
 
 
 #helper libraries
 import numpy as np
-import matplotlib.pyplot as plt
+import functools
 import time
 
 #get rid of some interpreter warnings
 import os
+import glob
+import hashlib
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 tf.get_logger().setLevel('ERROR')
 
 '''
 SETUP THE INPUT PIPELINE (portugal to english dictionary)
+Importing this module doesn't load anything. The dataset, the tokenizers and the trained
+model are created the first time they are needed by the memoized get_*() functions, so
+the layers can be used without paying for any of it. tensorflow_datasets is only imported
+in here as well.
 '''
 
 #load the datasets into memory
-examples, metadata = tfds.load('ted_hrlr_translate/pt_to_en', with_info=True,
-        as_supervised=True)
-train_examples, val_examples = examples['train'], examples['validation']
-
-try:
-    tokenizer_en = tfds.features.text.SubwordTextEncoder.load_from_file('tokenized_en')
-except Exception as e:
-    print("Creating tokenizers...")
-    #create subword tokenizer to break words into subwords if they are not in the dictionary
-    tokenizer_en = tfds.features.text.SubwordTextEncoder.build_from_corpus(
-         (en.numpy() for pt, en in train_examples), target_vocab_size=2**13) #2**13
-    tokenizer_en.save_to_file('tokenized_en')
-
-try:
-    tokenizer_pt = tfds.features.text.SubwordTextEncoder.load_from_file('tokenized_pt')
-except Exception as e:
-    print("Portuguese tokenizer being created...")
-    #do the same for the portuguese language
-    tokenizer_pt = tfds.features.text.SubwordTextEncoder.build_from_corpus(
-        (pt.numpy() for pt, en in train_examples), target_vocab_size=2**13)
-    tokenizer_pt.save_to_file('tokenized_pt')
+@functools.lru_cache(maxsize=None)
+def get_examples():
+    import tensorflow_datasets as tfds
+
+    examples, metadata = tfds.load('ted_hrlr_translate/pt_to_en', with_info=True,
+            as_supervised=True)
+    return examples['train'], examples['validation']
+
+#directory of an ingested midi corpus (see MIDI Files/ingest_midi.py). When set, the model is
+#trained on music instead: both tokenizers are a MidiTokenizer (see midi_tokenizer.py) and
+#every example is a window of MAX_LENGTH - 2 events with the window that follows it as target
+MUSIC_CORPUS = None
+
+#returns (tokenizer_pt, tokenizer_en), creating them the first time
+@functools.lru_cache(maxsize=None)
+def get_tokenizers():
+    if MUSIC_CORPUS:
+        import midi_tokenizer
+
+        tokenizer = midi_tokenizer.MidiTokenizer()
+        return tokenizer, tokenizer
+
+    import tensorflow_datasets as tfds
+
+    try:
+        tokenizer_en = tfds.features.text.SubwordTextEncoder.load_from_file('tokenized_en')
+        tokenizer_pt = tfds.features.text.SubwordTextEncoder.load_from_file('tokenized_pt')
+    except Exception as e:
+        import tokenizer_build
+
+        print("Creating tokenizers...")
+        #create subword tokenizers to break words into subwords if they are not in the dictionary.
+        #both languages are counted in one parallel, resumable pass (see tokenizer_build.py)
+        train_examples, _ = get_examples()
+        tokenizer_pt, tokenizer_en = tokenizer_build.build_tokenizers(train_examples, target_vocab_size=2**13) #2**13
+
+    return tokenizer_pt, tokenizer_en
 '''
+tokenizer_pt, tokenizer_en = get_tokenizers()
 sample_string = 'Hello from over here!'
 
 tokenized_string = tokenizer_en.encode(sample_string)
@@ -61,6 +83,8 @@ BATCH_SIZE = 64
 
 #add a start and end token to the input and target
 def encode(lang1, lang2):
+    tokenizer_pt, tokenizer_en = get_tokenizers()
+
     lang1 = [tokenizer_pt.vocab_size] + tokenizer_pt.encode(
             lang1.numpy()) + [tokenizer_pt.vocab_size+1]
 
@@ -78,6 +102,80 @@ def tf_encode(pt, en):
 
     return result_pt, result_en
 
+'''
+PRE-TOKENIZED CACHE
+tf_encode() goes through the python interpreter for every example, which serializes the
+input pipeline. Instead, the examples are tokenized once and written to TFRecord shards
+that are read back with graph-native, parallel ops. The shards are named after a hash of
+the saved tokenizer files, so they are rebuilt whenever the tokenizers change.
+'''
+TOKENIZED_DIR = './tokenized_data'
+TOKENIZED_SHARDS = 8
+
+tokenized_features = {
+        'pt': tf.io.FixedLenSequenceFeature([], tf.int64, allow_missing=True),
+        'en': tf.io.FixedLenSequenceFeature([], tf.int64, allow_missing=True),
+}
+
+#hash of the tokenizer vocabularies written by save_to_file()
+def tokenizer_fingerprint():
+    h = hashlib.sha1()
+    for prefix in ('tokenized_pt', 'tokenized_en'):
+        with open(prefix + '.subwords', 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+def tokenized_shard_paths(split, fingerprint):
+    return [os.path.join(TOKENIZED_DIR, '{}-{}-{:02d}-of-{:02d}.tfrecord'.format(
+            split, fingerprint, i, TOKENIZED_SHARDS)) for i in range(TOKENIZED_SHARDS)]
+
+#tokenize every example once (adding the start and end tokens) and write them round robin to the shards
+def write_tokenized(examples, paths):
+    writers = [tf.io.TFRecordWriter(path + '.tmp') for path in paths]
+
+    for n, (pt, en) in enumerate(examples):
+        lang1, lang2 = encode(pt, en)
+        example = tf.train.Example(features=tf.train.Features(feature={
+            'pt': tf.train.Feature(int64_list=tf.train.Int64List(value=lang1)),
+            'en': tf.train.Feature(int64_list=tf.train.Int64List(value=lang2)),
+        }))
+        writers[n % len(writers)].write(example.SerializeToString())
+
+    #only rename once everything is written so an interrupted run is never picked up as complete
+    for writer, path in zip(writers, paths):
+        writer.close()
+        os.replace(path + '.tmp', path)
+
+def parse_tokenized(record):
+    example = tf.io.parse_single_example(record, tokenized_features)
+    return example['pt'], example['en']
+
+#drop in replacement for examples.map(tf_encode)
+def load_tokenized(split, examples):
+    #the tokenizer files have to exist before they can be hashed
+    get_tokenizers()
+
+    fingerprint = tokenizer_fingerprint()
+    paths = tokenized_shard_paths(split, fingerprint)
+
+    if not all(os.path.exists(path) for path in paths):
+        print("Tokenizing the {} examples...".format(split))
+        os.makedirs(TOKENIZED_DIR, exist_ok=True)
+
+        #remove the shards that were made with an older tokenizer
+        for stale in glob.glob(os.path.join(TOKENIZED_DIR, split + '-*')):
+            os.remove(stale)
+
+        write_tokenized(examples, paths)
+
+    #interleaving the round robin shards one record at a time gives back the original order
+    dataset = tf.data.Dataset.from_tensor_slices(paths)
+    dataset = dataset.interleave(tf.data.TFRecordDataset,
+            cycle_length=TOKENIZED_SHARDS,
+            block_length=1,
+            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    return dataset.map(parse_tokenized, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
 #filter function used to drop sequences of over 40 characters (for speed purposes)
 MAX_LENGTH = 40
@@ -85,23 +183,126 @@ def filter_max_length(x, y, max_length=MAX_LENGTH):
     return tf.logical_and(tf.size(x) <= max_length,
             tf.size(y) <= max_length)
 
-#want to map the filter_max_lenghth and encode() functions to all elements of the dataset
-train_dataset = train_examples.map(tf_encode)
-train_dataset = train_dataset.filter(filter_max_length)
-#cache the dataset to memory to get a speedup while reading from it
-train_dataset = train_dataset.cache()
-train_dataset = train_dataset.shuffle(BUFFER_SIZE).padded_batch(BATCH_SIZE, padded_shapes=([None],[None])) ############CHECK THIS FOR POTENTIAL ERROR
-#
-#
-#______________________________________________________________________________________
-#
-#
-train_dataset = train_dataset.prefetch(tf.data.experimental.AUTOTUNE)
-
-val_dataset = val_examples.map(tf_encode)
-val_dataset = val_dataset.filter(filter_max_length).padded_batch(BATCH_SIZE, padded_shapes=([None],[None]))
-pt_batch, en_batch = next(iter(val_dataset))
-#print(pt_batch, en_batch)
+'''
+LENGTH BUCKETING
+padded_batch() on shuffled data pads every batch to its longest member, so a lot of the
+work in train_step is spent on padding. With USE_BUCKETING examples of similar length
+are grouped together first. Example lengths below BUCKET_BOUNDARIES[i] go to bucket i, the
+last bucket takes the rest (up to MAX_LENGTH). BUCKET_BATCH_SIZES has one entry per bucket
+so the short buckets can use larger batches. The batches stay (batch_size, seq_len) int64,
+so they still match train_step_signature and nothing is retraced.
+'''
+USE_BUCKETING = False
+BUCKET_BOUNDARIES = [10, 15, 20, 25, 30]
+BUCKET_BATCH_SIZES = [128, 96, 80, 64, 56, 48]
+
+'''
+TOKEN BUDGET BATCHING
+With TOKEN_BUDGET set, batches are sized by tokens instead of a fixed number of sentences:
+every bucket of TOKEN_BUDGET_BOUNDARIES gets as many sentences as fit in the budget at the
+bucket's longest length, so batch_size * seq_len never goes over TOKEN_BUDGET. That keeps
+memory and step time flat whatever the sentence lengths are. Combine with
+ACCUMULATION_STEPS (see make_train_step) to reach a larger effective batch.
+'''
+TOKEN_BUDGET = None # e.g. BATCH_SIZE * MAX_LENGTH
+TOKEN_BUDGET_BOUNDARIES = list(range(8, MAX_LENGTH + 1, 4))
+
+#sentences per bucket so that none of the batches go over the token budget.
+#boundaries and max_length default to TOKEN_BUDGET_BOUNDARIES and MAX_LENGTH as they are when called
+def token_budget_batch_sizes(token_budget, boundaries=None, max_length=None):
+    if boundaries is None:
+        boundaries = TOKEN_BUDGET_BOUNDARIES
+    if max_length is None:
+        max_length = MAX_LENGTH
+
+    #the longest example of bucket i is boundaries[i] - 1, the last bucket goes up to max_length
+    longest = [b - 1 for b in boundaries] + [max_length]
+    return [max(1, token_budget // length) for length in longest]
+
+def example_length(pt, en):
+    return tf.maximum(tf.size(pt), tf.size(en))
+
+#bucketing=None and token_budget=None follow USE_BUCKETING and TOKEN_BUDGET as they are when
+#called, token_budget=0 turns the budget off
+def batch_examples(dataset, bucketing=None, token_budget=None):
+    if bucketing is None:
+        bucketing = USE_BUCKETING
+    if token_budget is None:
+        token_budget = TOKEN_BUDGET
+
+    if token_budget:
+        boundaries = TOKEN_BUDGET_BOUNDARIES
+        return dataset.bucket_by_sequence_length(
+                example_length,
+                boundaries,
+                token_budget_batch_sizes(token_budget, boundaries),
+                padded_shapes=([None],[None]))
+
+    if bucketing:
+        return dataset.bucket_by_sequence_length(
+                example_length,
+                BUCKET_BOUNDARIES,
+                BUCKET_BATCH_SIZES,
+                padded_shapes=([None],[None]))
+
+    return dataset.padded_batch(BATCH_SIZE, padded_shapes=([None],[None]))
+
+#fraction of the tokens in the batched dataset that are padding
+def padding_ratio(dataset):
+    def count(state, batch):
+        padded, total = state
+        for t in batch:
+            padded += tf.reduce_sum(tf.cast(tf.equal(t, 0), tf.int64))
+            total += tf.size(t, out_type=tf.int64)
+        return padded, total
+
+    padded, total = dataset.reduce((tf.constant(0, tf.int64), tf.constant(0, tf.int64)), count)
+    return float(padded) / max(float(total), 1.0)
+
+def report_padding(dataset):
+    before = padding_ratio(batch_examples(dataset.shuffle(BUFFER_SIZE), bucketing=False, token_budget=0))
+    after = padding_ratio(batch_examples(dataset.shuffle(BUFFER_SIZE), bucketing=True, token_budget=0))
+
+    print('Padding ratio: {:.2%} with padded_batch, {:.2%} with bucketing'.format(before, after))
+    return before, after
+
+#the MUSIC_CORPUS windows are encoded with numpy in one go, so they skip the TFRecord cache
+def get_music_examples():
+    import midi_tokenizer
+
+    tokenizer, _ = get_tokenizers()
+    train, val = midi_tokenizer.corpus_windows(MUSIC_CORPUS, tokenizer, MAX_LENGTH - 2)
+
+    return tf.data.Dataset.from_tensor_slices(train), tf.data.Dataset.from_tensor_slices(val)
+
+#returns the tokenized (train, validation) examples, start and end tokens included
+def get_tokenized_examples():
+    if MUSIC_CORPUS:
+        return get_music_examples()
+
+    train_examples, val_examples = get_examples()
+
+    return load_tokenized('train', train_examples), load_tokenized('validation', val_examples)
+
+#returns the batched (train_dataset, val_dataset)
+@functools.lru_cache(maxsize=None)
+def get_datasets():
+    train_dataset, val_dataset = get_tokenized_examples()
+
+    #want to map the filter_max_lenghth and encode() functions to all elements of the dataset
+    train_dataset = train_dataset.filter(filter_max_length)
+    #cache the dataset to memory to get a speedup while reading from it
+    train_dataset = train_dataset.cache()
+    train_dataset = batch_examples(train_dataset.shuffle(BUFFER_SIZE))
+    train_dataset = train_dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    val_dataset = val_dataset.filter(filter_max_length).padded_batch(BATCH_SIZE, padded_shapes=([None],[None]))
+
+    return train_dataset, val_dataset
+'''
+pt_batch, en_batch = next(iter(get_datasets()[1]))
+print(pt_batch, en_batch)
+'''
 
 #helper for positional_encoding()
 def get_angles(pos, i, d_model):
@@ -125,8 +326,56 @@ def positional_encoding(position, d_model):
 
     return tf.cast(pos_encoding, dtype=tf.float32)
 
-pos_encoding = positional_encoding(50, 512)
+#the rows [start, start + length) of positional_encoding() computed with tf ops, used inside a
+#traced graph for the positions past the shared table. Done in float64 like the numpy version
+def positional_encoding_rows(start, length, d_model):
+    pos = tf.cast(tf.range(start, start + length), tf.float64)[:, tf.newaxis]
+    i = tf.range(d_model)[tf.newaxis, :]
+
+    angle_rates = 1 / tf.pow(tf.constant(10000, tf.float64), tf.cast(2 * (i//2), tf.float64) / d_model)
+    angle_rads = pos * angle_rates
+
+    #sin on the even indices, cos on the odd ones
+    angle_rads = tf.where(tf.equal(i % 2, 0), tf.sin(angle_rads), tf.cos(angle_rads))
+
+    return tf.cast(angle_rads[tf.newaxis, ...], dtype=tf.float32)
+
+#positional encoding tables shared by every Encoder and Decoder (of any number of models),
+#one per d_model. A table starts out with POSITION_TABLE_LENGTH rows, which covers every
+#sequence of the datasets (MAX_LENGTH plus the start/end tokens) with room to spare, and is
+#only grown when a longer sequence comes along
+POSITION_TABLE_LENGTH = 2 * MAX_LENGTH
+pos_encoding_tables = {}
+
+def get_positional_encoding_table(d_model, length=POSITION_TABLE_LENGTH):
+    table = pos_encoding_tables.get(d_model)
+    if table is None or table.shape[1] < length:
+        #at least double the table so a growing sequence only rebuilds it a few times
+        size = max(int(length), POSITION_TABLE_LENGTH) if table is None else max(int(length), 2 * table.shape[1])
+        #built eagerly even when first asked for while tracing, so every graph can capture it
+        with tf.init_scope():
+            table = positional_encoding(size, d_model)
+        pos_encoding_tables[d_model] = table
+    return table
+
+#returns the positional encoding of the positions [start, start + length), shape (1, length, d_model)
+def get_positional_encoding(length, d_model, start=0):
+    end = tf.get_static_value(start + length)
+
+    if end is not None:
+        return get_positional_encoding_table(d_model, end)[:, start:end, :]
+
+    #inside a traced graph (train_step, the decode loops) the length is a tensor. The table
+    #goes into the graph as a constant and is sliced with tf ops, only positions past its
+    #end are computed on the fly
+    table = get_positional_encoding_table(d_model)
+    end = start + length
+    return tf.cond(end <= table.shape[1],
+            lambda: table[:, start:end, :],
+            lambda: positional_encoding_rows(start, length, d_model))
+
 '''
+pos_encoding = positional_encoding(50, 512)
 print(pos_encoding.shape)
 
 plt.pcolormesh(pos_encoding[0], cmap='RdBu')
@@ -150,11 +399,25 @@ def create_look_ahead_mask(size):
     mask = 1 - tf.linalg.band_part(tf.ones((size, size)), -1, 0)
     return mask #(seq_len, seq_len)
 
+#value added to the masked attention logits. -1e9 doesn't fit in float16 (it would
+#become -inf), so the lowest float16 is used there. bfloat16 has the range of float32
+def mask_value(dtype):
+    if tf.as_dtype(dtype) == tf.float16:
+        return tf.float16.min
+    return -1e9
+
+#turns a 1/0 mask into the additive bias that is added to the attention logits.
+#The fused attention does this once per batch instead of once in every layer
+def create_attention_bias(mask, dtype=tf.float32):
+    if mask is None:
+        return None
+    return tf.cast(mask, dtype) * mask_value(dtype)
+
 
 '''
 SCALED DOT PRODUCT ATTENTION
 '''
-def scaled_dot_product_attention(q, k, v, mask):
+def scaled_dot_product_attention(q, k, v, mask, bias=None):
     ''' calculate the attention weights
     q,k,v must have matching leading dimensions
     k, v must have matching penultimate dimensions, i.e.: seq_len_k = seq_len_v
@@ -167,6 +430,8 @@ def scaled_dot_product_attention(q, k, v, mask):
         v: value shape == (..., seq_len_v, depth_v)
         mask: Float tensor with shape broadcastable to
             (..., seq_len_q, seq_len_k). Defaults to None.
+        bias: the same mask already turned into an additive bias
+            (see create_attention_bias). Defaults to None.
 
     Returns:
         output, attention_weights
@@ -175,17 +440,22 @@ def scaled_dot_product_attention(q, k, v, mask):
     matmul_qk = tf.matmul(q, k, transpose_b=True) #(..., sesq_len_q, seq_len_k)
 
     #scale matmul_qk
-    dk = tf.cast(tf.shape(k)[-1], tf.float32)
+    dk = tf.cast(tf.shape(k)[-1], matmul_qk.dtype)
     scaled_attention_logits = matmul_qk / tf.math.sqrt(dk)
 
     # add the mask to the scaled tensor
     if mask is not None:
-        scaled_attention_logits += (mask * -1e9)
+        scaled_attention_logits += create_attention_bias(mask, scaled_attention_logits.dtype)
+    if bias is not None:
+        scaled_attention_logits += tf.cast(bias, scaled_attention_logits.dtype)
 
     #softmax is normalized on the last axis (seq_len_k) so that the scores add to 1
     #this also does normalization on K, so the values decide the amount of 
-    #importance given to Q
-    attention_weights = tf.nn.softmax(scaled_attention_logits, axis=-1) # (seq_len_q, seq_len_k)
+    #importance given to Q. Under float16 the softmax itself is done in float32
+    if scaled_attention_logits.dtype == tf.float16:
+        attention_weights = tf.cast(tf.nn.softmax(tf.cast(scaled_attention_logits, tf.float32), axis=-1), tf.float16)
+    else:
+        attention_weights = tf.nn.softmax(scaled_attention_logits, axis=-1) # (seq_len_q, seq_len_k)
 
     output = tf.matmul(attention_weights, v) # (..., seq_len_q, depth_v)
 
@@ -204,10 +474,15 @@ def print_out(q, k, v):
 MULTI HEAD ATTENTION
 '''
 class MultiHeadAttention(tf.keras.layers.Layer):
-    def __init__(self, d_model, num_heads):
+    #fused=True packs the q/k/v projections of self attention (and k/v of cross attention)
+    #into a single matmul, expects the mask as an additive bias (see create_attention_bias)
+    #and only returns the attention weights when they are asked for. It uses the same
+    #wq/wk/wv variables, so checkpoints are interchangeable between the two modes
+    def __init__(self, d_model, num_heads, fused=False):
         super(MultiHeadAttention, self).__init__()
         self.num_heads = num_heads
         self.d_model = d_model
+        self.fused = fused
 
         assert d_model % self.num_heads == 0
 
@@ -226,20 +501,73 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         x = tf.reshape(x, (batch_size, -1, self.num_heads, self.depth))
         return tf.transpose(x, perm=[0,2,1,3])
 
-    def call(self, v, k, q, mask):
-        batch_size = tf.shape(q)[0]
+    def packed_projection(self, x, dense_layers):
+        #one matmul against the concatenated kernels of the given Dense layers,
+        #then split back into one (batch_size, seq_len, d_model) tensor per layer
+        for dense in dense_layers:
+            if not dense.built:
+                dense.build(tf.TensorShape([None, self.d_model]))
+
+        kernel = tf.concat([dense.kernel for dense in dense_layers], axis=-1) # (d_model, n * d_model)
+        bias = tf.concat([dense.bias for dense in dense_layers], axis=-1)
 
-        q = self.wq(q) # (batch_size, seq_len, d_model)
-        k = self.wk(k) # (batch_size, seq_len, d_model)
-        v = self.wv(v) # (batch_size, seq_len, d_model)
+        x = tf.tensordot(x, tf.cast(kernel, x.dtype), [[2], [0]]) + tf.cast(bias, x.dtype)
+        return tf.split(x, len(dense_layers), axis=-1)
+
+    def project_kv(self, v, k):
+        #project and split the keys and values only. Used to fill the cross attention
+        #cache once per sentence since the encoder output never changes while decoding
+        batch_size = tf.shape(k)[0]
+
+        if self.fused and k is v:
+            k, v = self.packed_projection(k, [self.wk, self.wv])
+        else:
+            k, v = self.wk(k), self.wv(v)
 
-        q = self.split_heads(q, batch_size) # (batch_size, num_heads, seq_len_q, depth)
         k = self.split_heads(k, batch_size) # (batch_size, num_heads, seq_len_k, depth)
         v = self.split_heads(v, batch_size) # (batch_size, num_heads, seq_len_v, depth)
+        return k, v
+
+    def call(self, v, k, q, mask, cache=None, static_kv=False, self_attention=False, return_attention_weights=None):
+        #cache is an optional dict holding the already split 'k' and 'v' tensors
+        #of the previous decoding steps. With static_kv=True the cached keys/values are
+        #used as is (cross attention), otherwise the new keys/values are appended to it.
+        #self_attention=True tells the fused mode that v, k and q are the same tensor.
+        #return_attention_weights defaults to True, or to False in the fused mode
+        batch_size = tf.shape(q)[0]
+
+        if return_attention_weights is None:
+            return_attention_weights = not self.fused
+
+        if self.fused and self_attention and not static_kv:
+            q, k, v = self.packed_projection(q, [self.wq, self.wk, self.wv])
+
+            q = self.split_heads(q, batch_size) # (batch_size, num_heads, seq_len_q, depth)
+            k = self.split_heads(k, batch_size) # (batch_size, num_heads, seq_len_k, depth)
+            v = self.split_heads(v, batch_size) # (batch_size, num_heads, seq_len_v, depth)
+        else:
+            q = self.wq(q) # (batch_size, seq_len, d_model)
+            q = self.split_heads(q, batch_size) # (batch_size, num_heads, seq_len_q, depth)
+
+            if static_kv:
+                k, v = cache['k'], cache['v']
+            else:
+                k, v = self.project_kv(v, k)
+
+        if cache is not None and not static_kv:
+            k = tf.concat([cache['k'], k], axis=2) # (batch_size, num_heads, cached_len + seq_len_k, depth)
+            v = tf.concat([cache['v'], v], axis=2)
+            cache['k'], cache['v'] = k, v
 
         #scaled_attention.shape == (batch_size, num_heads, seq_len_q, depth) -- for reference
         #attention_weights.shape == (batch_size, num_heads, seq_len_q, seq_len_k) -- for ref.
-        scaled_attention, attention_weights = scaled_dot_product_attention(q, k, v, mask)
+        if self.fused:
+            scaled_attention, attention_weights = scaled_dot_product_attention(q, k, v, None, bias=mask)
+        else:
+            scaled_attention, attention_weights = scaled_dot_product_attention(q, k, v, mask)
+
+        if not return_attention_weights:
+            attention_weights = None
 
         scaled_attention = tf.transpose(scaled_attention, perm=[0,2,1,3]) #(batch_size, seq_len_q, num_heads, depth)
         concat_attention = tf.reshape(scaled_attention, (batch_size, -1, self.d_model)) #(batch_size, seq_len_q, d_model)
@@ -269,11 +597,11 @@ def point_wise_feed_forward_network(d_model, dff):
 ENCODER LAYER
 '''
 class EncoderLayer(tf.keras.layers.Layer):
-    def __init__(self, d_model, num_heads, dff, rate=0.1):
+    def __init__(self, d_model, num_heads, dff, rate=0.1, fused=False):
         super(EncoderLayer, self).__init__()
         
         #multi head attention layer
-        self.mha = MultiHeadAttention(d_model, num_heads)
+        self.mha = MultiHeadAttention(d_model, num_heads, fused)
         #feed forward network layer
         self.ffn = point_wise_feed_forward_network(d_model, dff)
 
@@ -289,7 +617,8 @@ class EncoderLayer(tf.keras.layers.Layer):
 
         #each layer has a residual connection layer followed by layer normalization
 
-        attn_output, _ = self.mha(x, x, x, mask) # (batch_size, input_seq_len, d_model)
+        attn_output, _ = self.mha(x, x, x, mask, self_attention=True,
+                return_attention_weights=False) # (batch_size, input_seq_len, d_model)
         attn_output = self.dropout1(attn_output, training=training)
         out1 = self.layernorm1(x + attn_output) # (batch_size, input_seq_len, d_model)
 
@@ -304,11 +633,11 @@ DECODER LAYER
 '''
 
 class DecoderLayer(tf.keras.layers.Layer):
-    def __init__(self, d_model, num_heads, dff, rate=0.1):
+    def __init__(self, d_model, num_heads, dff, rate=0.1, fused=False):
         super(DecoderLayer, self).__init__()
 
-        self.mha1 = MultiHeadAttention(d_model, num_heads)
-        self.mha2 = MultiHeadAttention(d_model, num_heads)
+        self.mha1 = MultiHeadAttention(d_model, num_heads, fused)
+        self.mha2 = MultiHeadAttention(d_model, num_heads, fused)
 
         self.ffn = point_wise_feed_forward_network(d_model, dff)
 
@@ -320,14 +649,33 @@ class DecoderLayer(tf.keras.layers.Layer):
         self.dropout2 = tf.keras.layers.Dropout(rate)
         self.dropout3 = tf.keras.layers.Dropout(rate)
 
-    def call(self, x, enc_output, training, look_ahead_mask, padding_mask):
+    def init_cache(self, enc_output):
+        #empty self attention cache plus the projected encoder output for the 2nd block
+        batch_size = tf.shape(enc_output)[0]
+        empty = tf.zeros((batch_size, self.mha1.num_heads, 0, self.mha1.depth), dtype=enc_output.dtype)
+
+        enc_k, enc_v = self.mha2.project_kv(enc_output, enc_output)
+
+        return {'self': {'k': empty, 'v': empty},
+                'enc': {'k': enc_k, 'v': enc_v}}
+
+    def call(self, x, enc_output, training, look_ahead_mask, padding_mask, cache=None,
+            return_attention_weights=None):
         #enc_output.shape == (batch_size, input_seq_len, d_model)
+        #when a cache (see init_cache) is given, x only holds the newest target positions
 
-        attn1, attn_weight_blocks1 = self.mha1(x, x, x, look_ahead_mask) #(batch_size, target_seq_len, d_model)
+        self_cache = None if cache is None else cache['self']
+        attn1, attn_weight_blocks1 = self.mha1(x, x, x, look_ahead_mask, cache=self_cache,
+                self_attention=True, return_attention_weights=return_attention_weights) #(batch_size, target_seq_len, d_model)
         attn1 = self.dropout1(attn1, training=training)
         out1 = self.layernorm1(attn1 + x)
 
-        attn2, attn_weight_blocks2 = self.mha2(enc_output, enc_output, out1, padding_mask) #(batch_size, target_seq_len, d_model)
+        if cache is None:
+            attn2, attn_weight_blocks2 = self.mha2(enc_output, enc_output, out1, padding_mask,
+                    return_attention_weights=return_attention_weights) #(batch_size, target_seq_len, d_model)
+        else:
+            attn2, attn_weight_blocks2 = self.mha2(enc_output, enc_output, out1, padding_mask,
+                    cache=cache['enc'], static_kv=True, return_attention_weights=return_attention_weights)
         attn2 = self.dropout2(attn2, training=training)
         out2 = self.layernorm2(attn2 + out1) #(batch_size, target_seq_len, d_model)
 
@@ -358,19 +706,21 @@ consists of
 3. N number of encoder layers
 '''
 class Encoder(tf.keras.layers.Layer):
-    def __init__(self, num_layers, d_model, num_heads, dff, input_vocab_size, maximum_position_encoding, rate=0.1):
+    def __init__(self, num_layers, d_model, num_heads, dff, input_vocab_size, maximum_position_encoding, rate=0.1,
+            fused=False):
         super(Encoder, self).__init__()
 
         self.d_model = d_model
         self.num_layers = num_layers
+        self.fused = fused
 
         #input embedding
         self.embedding = tf.keras.layers.Embedding(input_vocab_size, d_model)
-        #positional encoding
-        self.pos_encoding = positional_encoding(maximum_position_encoding, self.d_model)
+        #positional encoding, shared between the models (see get_positional_encoding)
+        self.maximum_position_encoding = maximum_position_encoding
 
         #N encoder layers
-        self.enc_layers = [EncoderLayer(d_model, num_heads, dff, rate)
+        self.enc_layers = [EncoderLayer(d_model, num_heads, dff, rate, fused)
                 for _ in range(num_layers)]
         
         #residual connection(?)
@@ -382,11 +732,15 @@ class Encoder(tf.keras.layers.Layer):
 
         #adding embedding and positional encoding
         x = self.embedding(x) # (batch_size, input_seq_len, d_model)
-        x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
-        x += self.pos_encoding[:, :seq_len, :]
+        x *= tf.math.sqrt(tf.cast(self.d_model, x.dtype))
+        x += tf.cast(get_positional_encoding(seq_len, self.d_model), x.dtype)
 
         x = self.dropout(x, training=training)
 
+        #the fused attention takes the mask as an additive bias, built once for all of the layers
+        if self.fused:
+            mask = create_attention_bias(mask, self.compute_dtype)
+
         for i in range(self.num_layers):
             x = self.enc_layers[i](x, training, mask)
 
@@ -410,34 +764,56 @@ Consists of
 '''
 
 class Decoder(tf.keras.layers.Layer):
-    def __init__(self, num_layers, d_model, num_heads, dff, target_vocab_size, maximum_position_encoding, rate=0.1):
+    def __init__(self, num_layers, d_model, num_heads, dff, target_vocab_size, maximum_position_encoding, rate=0.1,
+            fused=False):
         super(Decoder, self).__init__()
 
         self.d_model = d_model
         self.num_layers = num_layers
+        self.fused = fused
         
         self.embedding = tf.keras.layers.Embedding(target_vocab_size, d_model)
-        self.pos_encoding = positional_encoding(maximum_position_encoding, d_model)
+        self.maximum_position_encoding = maximum_position_encoding
 
-        self.dec_layers = [DecoderLayer(d_model, num_heads, dff, rate)
+        self.dec_layers = [DecoderLayer(d_model, num_heads, dff, rate, fused)
                 for _ in range(num_layers)]
         self.dropout = tf.keras.layers.Dropout(rate)
 
-    def call(self, x, enc_output, training, look_ahead_mask, padding_mask):
+    def init_cache(self, enc_output):
+        #one key/value cache per decoder layer, used for incremental decoding
+        return {'decoder_layer{}'.format(i+1): self.dec_layers[i].init_cache(enc_output)
+                for i in range(self.num_layers)}
+
+    def call(self, x, enc_output, training, look_ahead_mask, padding_mask, cache=None,
+            return_attention_weights=None):
         seq_len = tf.shape(x)[1]
         attention_weights = {}
 
+        #with a cache x only holds the new tokens, so the positions continue after the cached prefix
+        start = 0
+        if cache is not None:
+            start = tf.shape(cache['decoder_layer1']['self']['k'])[2]
+
         x = self.embedding(x) #(batch_size, target_seq_len, d_model)
-        x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
-        x += self.pos_encoding[:, :seq_len, :]
+        x *= tf.math.sqrt(tf.cast(self.d_model, x.dtype))
+        x += tf.cast(get_positional_encoding(seq_len, self.d_model, start), x.dtype)
 
         x = self.dropout(x, training=training)
 
+        #the fused attention takes the masks as additive biases, built once for all of the layers
+        if self.fused:
+            look_ahead_mask = create_attention_bias(look_ahead_mask, self.compute_dtype)
+            padding_mask = create_attention_bias(padding_mask, self.compute_dtype)
+
         for i in range(self.num_layers):
-            x, block1, block2 = self.dec_layers[i](x, enc_output, training, look_ahead_mask, padding_mask)
+            layer_cache = None if cache is None else cache['decoder_layer{}'.format(i+1)]
+            x, block1, block2 = self.dec_layers[i](x, enc_output, training, look_ahead_mask, padding_mask,
+                    cache=layer_cache, return_attention_weights=return_attention_weights)
 
-            attention_weights['decoder_layer{}_block1'.format(i+1)] = block1
-            attention_weights['decoder_layer{}_block2'.format(i+1)] = block2
+            #the fused attention leaves the weights out unless they were asked for
+            if block1 is not None:
+                attention_weights['decoder_layer{}_block1'.format(i+1)] = block1
+                attention_weights['decoder_layer{}_block2'.format(i+1)] = block2
 
         #x.shape == (batch_size, target_seq_len, d_model)
         return x, attention_weights
@@ -458,18 +834,31 @@ Consists of encoder, decoder and a final linear layer. The output of the decoder
 '''
 
 class Transformer(tf.keras.Model):
-    def __init__(self, num_layers, d_model, num_heads, dff, input_vocab_size, target_vocab_size, pe_input, pe_target, rate=0.1):
+    #fused=True switches every attention layer to the fused fast path (see MultiHeadAttention)
+    def __init__(self, num_layers, d_model, num_heads, dff, input_vocab_size, target_vocab_size, pe_input, pe_target, rate=0.1,
+            fused=False):
         super(Transformer, self).__init__()
 
-        self.encoder = Encoder(num_layers, d_model, num_heads, dff, input_vocab_size, pe_input, rate)
-        self.decoder = Decoder(num_layers, d_model, num_heads, dff, target_vocab_size, pe_target, rate)
-        self.final_layer = tf.keras.layers.Dense(target_vocab_size)
+        self.encoder = Encoder(num_layers, d_model, num_heads, dff, input_vocab_size, pe_input, rate, fused)
+        self.decoder = Decoder(num_layers, d_model, num_heads, dff, target_vocab_size, pe_target, rate, fused)
+        #the logits are kept in float32 under mixed precision so the loss and softmax stay stable
+        self.final_layer = tf.keras.layers.Dense(target_vocab_size, dtype='float32')
 
-    def call(self, inp, tar, training, enc_padding_mask, look_ahead_mask, dec_padding_mask):
+    def call(self, inp, tar, training, enc_padding_mask, look_ahead_mask, dec_padding_mask,
+            return_attention_weights=None):
         enc_output = self.encoder(inp, training, enc_padding_mask) # (batch_size, inp_seq_len, d_model)
 
+        return self.decode(tar, enc_output, training, look_ahead_mask, dec_padding_mask,
+                return_attention_weights=return_attention_weights)
+
+    def decode(self, tar, enc_output, training, look_ahead_mask, dec_padding_mask, cache=None,
+            return_attention_weights=None):
+        #runs the decoder and the final layer on an already encoded input.
+        #pass a cache from self.decoder.init_cache() to only feed the newest token(s)
+
         #dec_output.shape == (batch_size, tar_seq_len, d_model)
-        dec_output, attention_weights = self.decoder(tar, enc_output, training, look_ahead_mask, dec_padding_mask)
+        dec_output, attention_weights = self.decoder(tar, enc_output, training, look_ahead_mask, dec_padding_mask,
+                cache=cache, return_attention_weights=return_attention_weights)
 
         final_output = self.final_layer(dec_output) #(batch_size, tar_seq_len, target_vocab_size)
 
@@ -499,13 +888,25 @@ d_model=128
 dff=512
 num_heads=8
 
-input_vocab_size = tokenizer_pt.vocab_size + 2
-target_vocab_size = tokenizer_en.vocab_size + 2
 dropout_rate = 0.1
 
+#fused attention fast path (see MultiHeadAttention), loads the same checkpoints
+use_fused_attention = False
+
+#training mode. TRAIN_PRECISION is a keras mixed precision policy: 'float32', 'mixed_bfloat16'
+#or 'mixed_float16' (which also turns on loss scaling). TRAIN_JIT_COMPILE compiles
+#train_step with XLA. See train_benchmark.py for how the combinations compare
+TRAIN_PRECISION = 'float32'
+TRAIN_JIT_COMPILE = False
+
+#number of batches whose gradients are averaged into every optimizer update
+ACCUMULATION_STEPS = 1
+
 '''
 OPTIMIZER
 '''
+#step is the optimizer's iteration count, which only advances when apply_gradients() runs,
+#so with gradient accumulation the schedule moves once per update, not per batch
 class CustomSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
     def __init__(self, d_model, warmup_steps=4000):
         super(CustomSchedule, self).__init__()
@@ -516,16 +917,31 @@ class CustomSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
         self.warmup_steps = warmup_steps
 
     def __call__(self, step):
+        #newer optimizers pass their integer iteration count
+        step = tf.cast(step, tf.float32)
+
         arg1 = tf.math.rsqrt(step)
         arg2 = step * (self.warmup_steps ** -1.5)
 
         return tf.math.rsqrt(self.d_model) * tf.math.minimum(arg1, arg2)
 
-learning_rate = CustomSchedule(d_model)
+def create_optimizer(precision=TRAIN_PRECISION):
+    learning_rate = CustomSchedule(d_model)
 
-optimizer = tf.keras.optimizers.Adam(learning_rate, beta_1=0.9, beta_2=0.98, epsilon=1e-9)
-temp_learning_rate_schedule = CustomSchedule(d_model)
+    optimizer = tf.keras.optimizers.Adam(learning_rate, beta_1=0.9, beta_2=0.98, epsilon=1e-9)
+
+    #float16 gradients underflow without loss scaling
+    if precision == 'mixed_float16':
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+
+    return optimizer
+
+@functools.lru_cache(maxsize=None)
+def get_optimizer():
+    return create_optimizer(TRAIN_PRECISION)
 '''
+temp_learning_rate_schedule = CustomSchedule(d_model)
+
 plt.plot(temp_learning_rate_schedule(tf.range(40000, dtype=tf.float32)))
 plt.ylabel("Learning Rate")
 plt.xlabel("Train Step")
@@ -548,12 +964,13 @@ def loss_function(real, pred):
 
     return tf.reduce_mean(loss_)
 
-train_loss = tf.keras.metrics.Mean(name='train_loss')
-train_accuracy = tf.keras.metrics.SparseCategoricalAccuracy(name='train_accuracy')
+#returns (train_loss, train_accuracy)
+@functools.lru_cache(maxsize=None)
+def get_train_metrics():
+    train_loss = tf.keras.metrics.Mean(name='train_loss')
+    train_accuracy = tf.keras.metrics.SparseCategoricalAccuracy(name='train_accuracy')
 
-transformer = Transformer(num_layers, d_model, num_heads, dff, input_vocab_size,
-        target_vocab_size, pe_input=input_vocab_size, pe_target=target_vocab_size,
-        rate=dropout_rate)
+    return train_loss, train_accuracy
 
 def create_masks(inp, tar):
     #Encoder padding mask
@@ -573,15 +990,38 @@ def create_masks(inp, tar):
 
 #create the checkpoint path and the checkpoint manager. This will be used to save checkpoints ever N epochs
 checkpoint_path = "./checkpoints/train"
+#the music model has another vocabulary, so it can't share the checkpoints
+music_checkpoint_path = "./checkpoints/music"
+
+#builds the transformer for the tokenizers' vocabularies and restores the latest checkpoint
+@functools.lru_cache(maxsize=None)
+def get_checkpoint_manager():
+    tokenizer_pt, tokenizer_en = get_tokenizers()
+
+    input_vocab_size = tokenizer_pt.vocab_size + 2
+    target_vocab_size = tokenizer_en.vocab_size + 2
+
+    #the layers pick up the precision policy when they are created
+    tf.keras.mixed_precision.set_global_policy(TRAIN_PRECISION)
+
+    transformer = Transformer(num_layers, d_model, num_heads, dff, input_vocab_size,
+            target_vocab_size, pe_input=input_vocab_size, pe_target=target_vocab_size,
+            rate=dropout_rate, fused=use_fused_attention)
+
+    ckpt = tf.train.Checkpoint(transformer=transformer, optimizer=get_optimizer())
+
+    ckpt_manager = tf.train.CheckpointManager(ckpt,
+            music_checkpoint_path if MUSIC_CORPUS else checkpoint_path, max_to_keep=5)
 
-ckpt = tf.train.Checkpoint(transformer=transformer, optimizer=optimizer)
+    #if a checkpoint exists, restore the latest checkpoint
+    if ckpt_manager.latest_checkpoint:
+        ckpt.restore(ckpt_manager.latest_checkpoint)
+        print('Latest checkpoint restored!!')
 
-ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_path, max_to_keep=5)
+    return ckpt_manager
 
-#if a checkpoint exists, restore the latest checkpoint
-if ckpt_manager.latest_checkpoint:
-    ckpt.restore(ckpt_manager.latest_checkpoint)
-    print('Latest checkpoint restored!!')
+def get_transformer():
+    return get_checkpoint_manager().checkpoint.transformer
 
 EPOCHS = 20
 
@@ -596,54 +1036,127 @@ train_step_signature = [
         tf.TensorSpec(shape=(None, None), dtype=tf.int64),
 ]
 
-@tf.function(input_signature=train_step_signature)
-def train_step(inp, tar):
-    tar_inp = tar[:, :-1]
-    tar_real = tar[:, 1:]
-
-    enc_padding_mask, combined_mask, dec_padding_mask = create_masks(inp, tar_inp)
+#builds the compiled train step for the given model. jit_compile=True has XLA compile it,
+#and with a LossScaleOptimizer (mixed_float16) the loss is scaled before the gradients
+#are taken and the gradients are unscaled again before they are applied.
+#With accumulation_steps > 1 the gradients of that many calls are summed into
+#accumulator variables and their average is applied once every accumulation_steps calls
+def make_train_step(transformer, optimizer, train_loss, train_accuracy, jit_compile=False,
+        accumulation_steps=1):
+    scale_loss = isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+    accumulators = []
+
+    def compute_gradients(inp, tar):
+        tar_inp = tar[:, :-1]
+        tar_real = tar[:, 1:]
+
+        enc_padding_mask, combined_mask, dec_padding_mask = create_masks(inp, tar_inp)
+
+        with tf.GradientTape() as tape:
+            predictions, _ = transformer(inp, tar_inp,
+                    True,
+                    enc_padding_mask,
+                    combined_mask,
+                    dec_padding_mask)
+            loss = loss_function(tar_real, predictions)
+            scaled_loss = optimizer.get_scaled_loss(loss) if scale_loss else loss
+        gradients = tape.gradient(scaled_loss, transformer.trainable_variables)
+        if scale_loss:
+            gradients = optimizer.get_unscaled_gradients(gradients)
+        train_loss(loss)
+        train_accuracy(tar_real, predictions)
+
+        return gradients
+
+    @tf.function(input_signature=train_step_signature, jit_compile=jit_compile)
+    def train_step(inp, tar):
+        gradients = compute_gradients(inp, tar)
+        optimizer.apply_gradients(zip(gradients, transformer.trainable_variables))
+
+    if accumulation_steps == 1:
+        return train_step
+
+    @tf.function(input_signature=train_step_signature, jit_compile=jit_compile)
+    def accumulate_step(inp, tar):
+        gradients = compute_gradients(inp, tar)
+
+        #the model (and so the shape of every gradient) only exists after the first forward pass
+        if not accumulators:
+            with tf.init_scope():
+                for var in transformer.trainable_variables:
+                    accumulators.append(tf.Variable(tf.zeros(var.shape, var.dtype), trainable=False))
+
+        for accumulator, gradient in zip(accumulators, gradients):
+            #the embedding gradients are IndexedSlices
+            accumulator.assign_add(tf.convert_to_tensor(gradient))
+
+    @tf.function
+    def apply_step():
+        optimizer.apply_gradients([(accumulator / accumulation_steps, var)
+                for accumulator, var in zip(accumulators, transformer.trainable_variables)])
+
+        for accumulator in accumulators:
+            accumulator.assign(tf.zeros_like(accumulator))
+
+    #counts the batches since the last update, a partial accumulation carries over to the next epoch
+    pending = [0]
+
+    def accumulating_train_step(inp, tar):
+        accumulate_step(inp, tar)
+        pending[0] += 1
+
+        if pending[0] == accumulation_steps:
+            apply_step()
+            pending[0] = 0
+
+    return accumulating_train_step
+
+@functools.lru_cache(maxsize=None)
+def get_train_step():
+    train_loss, train_accuracy = get_train_metrics()
+
+    return make_train_step(get_transformer(), get_optimizer(), train_loss, train_accuracy,
+            jit_compile=TRAIN_JIT_COMPILE, accumulation_steps=ACCUMULATION_STEPS)
 
-    with tf.GradientTape() as tape:
-        predictions, _ = transformer(inp, tar_inp,
-                True,
-                enc_padding_mask,
-                combined_mask,
-                dec_padding_mask)
-        loss = loss_function(tar_real, predictions)
-    gradients = tape.gradient(loss, transformer.trainable_variables)
-    optimizer.apply_gradients(zip(gradients, transformer.trainable_variables))
-    train_loss(loss)
-    train_accuracy(tar_real, predictions)
+def train_step(inp, tar):
+    get_train_step()(inp, tar)
 
 '''
 TRAIN THE DATA
 '''
 
-'''
-#portuguese is used as the input language and english as the target language
-for epoch in range(EPOCHS):
-    start = time.time()
+#not called by main(), run model.train() to continue training from the latest checkpoint
+def train(epochs=EPOCHS):
+    train_dataset, _ = get_datasets()
+    train_loss, train_accuracy = get_train_metrics()
+    ckpt_manager = get_checkpoint_manager()
 
-    train_loss.reset_states()
-    train_accuracy.reset_states()
+    #portuguese is used as the input language and english as the target language
+    for epoch in range(epochs):
+        start = time.time()
 
-    #inp -> portuguese, tar -> english
-    for (batch, (inp, tar)) in enumerate(train_dataset):
-        train_step(inp, tar)
+        train_loss.reset_states()
+        train_accuracy.reset_states()
 
-        if batch % 50 == 0:
-            print ('Epoch {} Batch {} Loss {:.4f} Accuracy {:.4f}'.format(
-                epoch + 1, batch, train_loss.result(), train_accuracy.result()))
-    if(epoch + 1) % 5 == 0:
-        ckpt_save_path = ckpt_manager.save()
-        print('Saving checkpoint for epoch {} at {}'.format(epoch+1, ckpt_save_path))
+        #inp -> portuguese, tar -> english
+        for (batch, (inp, tar)) in enumerate(train_dataset):
+            train_step(inp, tar)
 
-    print('Epoch {} Loss {:.4f} Accuracy {:.4f}'.format(epoch+1, train_loss.result(), train_accuracy.result()))
+            if batch % 50 == 0:
+                print ('Epoch {} Batch {} Loss {:.4f} Accuracy {:.4f}'.format(
+                    epoch + 1, batch, train_loss.result(), train_accuracy.result()))
+        if(epoch + 1) % 5 == 0:
+            ckpt_save_path = ckpt_manager.save()
+            print('Saving checkpoint for epoch {} at {}'.format(epoch+1, ckpt_save_path))
 
-    print('Time taken for 1 epoch: {} secs\n'.format(time.time() - start))
-'''
+        print('Epoch {} Loss {:.4f} Accuracy {:.4f}'.format(epoch+1, train_loss.result(), train_accuracy.result()))
+
+        print('Time taken for 1 epoch: {} secs\n'.format(time.time() - start))
+
+def evaluate(inp_sentence, use_cache=True):
+    tokenizer_pt, tokenizer_en = get_tokenizers()
+    transformer = get_transformer()
 
-def evaluate(inp_sentence):
     start_token = [tokenizer_pt.vocab_size]
     end_token = [tokenizer_pt.vocab_size + 1]
 
@@ -656,6 +1169,9 @@ def evaluate(inp_sentence):
     decoder_input = [tokenizer_en.vocab_size]
     output = tf.expand_dims(decoder_input, 0)
 
+    if use_cache:
+        return evaluate_cached(encoder_input, output)
+
     for i in range(MAX_LENGTH):
         enc_padding_mask, combined_mask, dec_padding_mask = create_masks(encoder_input, output)
 
@@ -665,7 +1181,8 @@ def evaluate(inp_sentence):
                 False,
                 enc_padding_mask,
                 combined_mask,
-                dec_padding_mask)
+                dec_padding_mask,
+                return_attention_weights=True)
 
         #select the last word from the seq_len dimension
         predictions = predictions[: ,-1:, :] # (batch_size, 1, vocab_size)
@@ -681,7 +1198,401 @@ def evaluate(inp_sentence):
 
     return tf.squeeze(output, axis=0), attention_weights
 
+def evaluate_cached(encoder_input, output):
+    #same greedy decoding as evaluate(), but the encoder only runs once and every
+    #decoder layer keeps the keys/values of the previous steps, so each step
+    #only pushes the newest token through the decoder
+    tokenizer_pt, tokenizer_en = get_tokenizers()
+    transformer = get_transformer()
+
+    enc_padding_mask = create_padding_mask(encoder_input)
+    dec_padding_mask = create_padding_mask(encoder_input)
+
+    enc_output = transformer.encoder(encoder_input, False, enc_padding_mask)
+    cache = transformer.decoder.init_cache(enc_output)
+
+    #attention rows of every step, stitched back together into the full matrices at the end
+    attention_steps = {}
+
+    def collect_attention():
+        attention_weights = {}
+        seq_len = len(attention_steps['decoder_layer1_block2'])
+        for name, steps in attention_steps.items():
+            #pad the self attention rows with the (fully masked) future positions
+            steps = [tf.pad(w, [[0, 0], [0, 0], [0, 0], [0, seq_len - tf.shape(w)[-1]]])
+                    if name.endswith('block1') else w for w in steps]
+            attention_weights[name] = tf.concat(steps, axis=2)
+        return attention_weights
+
+    for i in range(MAX_LENGTH):
+        #the newest token may look at the whole prefix, so only the target padding has to be masked
+        look_ahead_mask = create_padding_mask(output) # (batch_size, 1, 1, seq_len)
+
+        #predictions.shape == (batch_size, 1, vocab_size)
+        predictions, attention_weights = transformer.decode(output[:, -1:],
+                enc_output,
+                False,
+                look_ahead_mask,
+                dec_padding_mask,
+                cache=cache,
+                return_attention_weights=True)
+
+        for name, weights in attention_weights.items():
+            attention_steps.setdefault(name, []).append(weights)
+
+        predicted_id = tf.cast(tf.argmax(predictions, axis=-1), tf.int32)
+
+        #return the result if the predicted_id is equal to the end token
+        if predicted_id == tokenizer_en.vocab_size+1:
+            return tf.squeeze(output, axis=0), collect_attention()
+
+        #concatenate the predicted_id to the output which is given to the decoder as input
+        output = tf.concat([output, predicted_id], axis=-1)
+
+    return tf.squeeze(output, axis=0), collect_attention()
+
+def decode_batch(encoder_input, max_length=MAX_LENGTH):
+    #greedy cached decoding of a whole (zero padded) batch at once. Every row keeps
+    #its own end flag, finished rows are fed padding and the loop stops as soon
+    #as all of the rows have produced the end token. It's the compiled loop of the
+    #'sample' strategy with an argmax in place of the draw (see make_decode_sampled),
+    #so nothing goes back to python between the steps
+    batch_size = tf.shape(encoder_input)[0]
+
+    return get_decode_greedy()(tf.cast(encoder_input, tf.int32), tf.zeros((batch_size,), tf.int64),
+            max_length, 1.0, 1, 1.0)
+
+'''
+SAMPLING AND BEAM SEARCH
+Greedy decoding always takes the most likely token, which makes generated music loop on
+itself. The 'sample' strategy draws every token from the predicted distribution instead,
+reshaped by:
+ - DECODE_TEMPERATURE: the logits are divided by it, below 1 sharpens and above 1 flattens
+ - DECODE_TOP_K: only the k most likely tokens can be drawn (0 keeps all of them)
+ - DECODE_TOP_P: only the most likely tokens whose probabilities add up to p (1 keeps all of them)
+The 'beam' strategy keeps the BEAM_SIZE most likely sequences of every row and returns the
+best one, its log probability divided by the GNMT length penalty ((5 + length) / 6) ** LENGTH_PENALTY.
+
+Both run the whole decode loop as one tf.while_loop in a tf.function: the output, the end
+flags and the key/value cache are loop variables and the stop condition is a tensor, so
+nothing goes back to python between steps. Every row draws with its own seed through the
+stateless random ops, so a prompt gives the same result for the same seed whatever else
+is in its batch.
+'''
+DECODE_STRATEGIES = ('greedy', 'sample', 'beam')
+DECODE_STRATEGY = 'greedy'
+DECODE_TEMPERATURE = 1.0
+DECODE_TOP_K = 0
+DECODE_TOP_P = 1.0
+DECODE_SEED = 0
+BEAM_SIZE = 4
+LENGTH_PENALTY = 0.6
+
+#logits (batch_size, vocab_size) with every token that can't be drawn set to -inf
+def filter_logits(logits, temperature, top_k, top_p):
+    logits = logits / temperature
+    vocab_size = tf.shape(logits)[-1]
+
+    #one sort gives both cutoffs, the k-th largest logit and the last one of the nucleus
+    sorted_logits = tf.sort(logits, axis=-1, direction='DESCENDING')
+    k = tf.where(top_k > 0, tf.minimum(top_k, vocab_size), vocab_size)
+
+    #probability of all the more likely tokens, the most likely token is always kept
+    cumulative = tf.cumsum(tf.nn.softmax(sorted_logits), axis=-1, exclusive=True)
+    nucleus = tf.reduce_sum(tf.cast(cumulative < top_p, tf.int32), axis=-1)
+
+    kept = tf.maximum(tf.minimum(nucleus, k), 1) # (batch_size,)
+    threshold = tf.gather(sorted_logits, kept - 1, axis=-1, batch_dims=1)[:, tf.newaxis]
+
+    return tf.where(logits < threshold, tf.constant(-np.inf, logits.dtype), logits)
+
+#one token per row with the Gumbel-max trick, argmax(logits + gumbel noise) is a draw from
+#softmax(logits). The noise of every row comes from [its seed, step]
+def sample_logits(logits, seeds, step):
+    vocab_size = tf.shape(logits)[-1]
+    step_seeds = tf.stack([seeds, tf.fill(tf.shape(seeds), tf.cast(step, seeds.dtype))], axis=-1)
+
+    noise = tf.map_fn(lambda seed: tf.random.stateless_uniform([vocab_size], seed,
+            minval=np.finfo(np.float32).tiny, maxval=1.0), step_seeds, fn_output_signature=tf.float32)
+    gumbel = -tf.math.log(-tf.math.log(noise))
+
+    return tf.cast(tf.argmax(logits + tf.cast(gumbel, logits.dtype), axis=-1), tf.int32)
+
+#the cache may grow along every axis inside the while loop
+def cache_shape_invariants(cache):
+    return tf.nest.map_structure(lambda t: tf.TensorShape([None] * len(t.shape)), cache)
+
+#greedy=True builds the same loop with an argmax in place of the draw, the seeds and the
+#sampling settings are ignored then
+def make_decode_sampled(transformer, start_id, end_id, greedy=False):
+    @tf.function(input_signature=[
+            tf.TensorSpec(shape=(None, None), dtype=tf.int32), # encoder_input
+            tf.TensorSpec(shape=(None,), dtype=tf.int64),      # seeds
+            tf.TensorSpec(shape=(), dtype=tf.int32),           # max_length
+            tf.TensorSpec(shape=(), dtype=tf.float32),         # temperature
+            tf.TensorSpec(shape=(), dtype=tf.int32),           # top_k
+            tf.TensorSpec(shape=(), dtype=tf.float32)])        # top_p
+    def decode_sampled(encoder_input, seeds, max_length, temperature, top_k, top_p):
+        #same loop as decode_batch(), with the argmax replaced by a draw
+        batch_size = tf.shape(encoder_input)[0]
+
+        enc_padding_mask = create_padding_mask(encoder_input)
+        enc_output = transformer.encoder(encoder_input, False, enc_padding_mask)
+        cache = transformer.decoder.init_cache(enc_output)
+
+        output = tf.fill((batch_size, 1), start_id) # (batch_size, 1)
+        finished = tf.zeros((batch_size,), dtype=tf.bool)
+
+        def step(i, output, finished, cache):
+            #the attention layers write the new keys/values into the dicts, so they get fresh ones
+            cache = tf.nest.map_structure(tf.identity, cache)
+
+            predictions, _ = transformer.decode(output[:, -1:],
+                    enc_output,
+                    False,
+                    create_padding_mask(output),
+                    enc_padding_mask,
+                    cache=cache)
+
+            if greedy:
+                predicted_id = tf.argmax(predictions[:, -1, :], axis=-1, output_type=tf.int32)
+            else:
+                logits = filter_logits(predictions[:, -1, :], temperature, top_k, top_p)
+                predicted_id = sample_logits(logits, seeds, i)
+            predicted_id = tf.where(finished, tf.zeros_like(predicted_id), predicted_id)
+
+            finished = tf.logical_or(finished, tf.equal(predicted_id, end_id))
+            output = tf.concat([output, predicted_id[:, tf.newaxis]], axis=-1)
+            return i + 1, output, finished, cache
+
+        def running(i, output, finished, cache):
+            return tf.logical_and(i < max_length, tf.logical_not(tf.reduce_all(finished)))
+
+        _, output, _, _ = tf.while_loop(running, step, (tf.constant(0), output, finished, cache),
+                shape_invariants=(tf.TensorShape([]), tf.TensorShape([None, None]), finished.shape,
+                        cache_shape_invariants(cache)))
+        return output
+
+    return decode_sampled
+
+def make_decode_beam(transformer, start_id, end_id):
+    @tf.function(input_signature=[
+            tf.TensorSpec(shape=(None, None), dtype=tf.int32), # encoder_input
+            tf.TensorSpec(shape=(), dtype=tf.int32),           # max_length
+            tf.TensorSpec(shape=(), dtype=tf.int32),           # beam_size
+            tf.TensorSpec(shape=(), dtype=tf.float32)])        # length_penalty
+    def decode_beam(encoder_input, max_length, beam_size, length_penalty):
+        batch_size = tf.shape(encoder_input)[0]
+        beams = batch_size * beam_size
+
+        #the encoder runs once per row, then every row is repeated for its beams (next to each other)
+        enc_padding_mask = create_padding_mask(encoder_input)
+        enc_output = transformer.encoder(encoder_input, False, enc_padding_mask)
+        enc_output = tf.repeat(enc_output, beam_size, axis=0)
+        enc_padding_mask = tf.repeat(enc_padding_mask, beam_size, axis=0)
+        cache = transformer.decoder.init_cache(enc_output)
+
+        output = tf.fill((beams, 1), start_id) # (batch_size * beam_size, 1)
+        #only the first beam of a row starts out alive, or every beam would pick the same tokens
+        scores = tf.tile(tf.concat([[0.0], tf.fill([beam_size - 1], -np.inf)], axis=0), [batch_size])
+        finished = tf.zeros((beams,), dtype=tf.bool)
+        lengths = tf.zeros((beams,), dtype=tf.int32)
+
+        def step(i, output, scores, finished, lengths, cache):
+            cache = tf.nest.map_structure(tf.identity, cache)
+
+            predictions, _ = transformer.decode(output[:, -1:],
+                    enc_output,
+                    False,
+                    create_padding_mask(output),
+                    enc_padding_mask,
+                    cache=cache)
+
+            log_probs = tf.nn.log_softmax(predictions[:, -1, :]) # (beams, vocab_size)
+            vocab_size = tf.shape(log_probs)[-1]
+
+            #a finished beam can only go on with padding, which costs nothing
+            padding_only = tf.one_hot(0, vocab_size, on_value=0.0, off_value=-np.inf, dtype=log_probs.dtype)
+            log_probs = tf.where(finished[:, tf.newaxis], padding_only[tf.newaxis, :], log_probs)
+
+            #the beam_size best continuations over all of the beams of a row
+            candidates = tf.reshape(scores[:, tf.newaxis] + log_probs, (batch_size, -1))
+            scores, indices = tf.math.top_k(candidates, beam_size) # (batch_size, beam_size)
+            predicted_id = tf.reshape(indices % vocab_size, [-1])
+
+            #the beam every continuation extends, as an index into the beams of the whole batch
+            parent = tf.reshape(indices // vocab_size + tf.range(batch_size)[:, tf.newaxis] * beam_size, [-1])
+
+            output = tf.concat([tf.gather(output, parent), predicted_id[:, tf.newaxis]], axis=-1)
+            lengths = tf.gather(lengths + tf.cast(tf.logical_not(finished), tf.int32), parent)
+            finished = tf.logical_or(tf.gather(finished, parent), tf.equal(predicted_id, end_id))
+
+            #the cross attention keys/values are the same for all of the beams of a row
+            for layer_cache in cache.values():
+                layer_cache['self'] = tf.nest.map_structure(lambda t: tf.gather(t, parent), layer_cache['self'])
+
+            return i + 1, output, tf.reshape(scores, [-1]), finished, lengths, cache
+
+        def running(i, output, scores, finished, lengths, cache):
+            return tf.logical_and(i < max_length, tf.logical_not(tf.reduce_all(finished)))
+
+        _, output, scores, _, lengths, _ = tf.while_loop(running, step,
+                (tf.constant(0), output, scores, finished, lengths, cache),
+                shape_invariants=(tf.TensorShape([]), tf.TensorShape([None, None]), scores.shape,
+                        finished.shape, lengths.shape, cache_shape_invariants(cache)))
+
+        penalty = tf.pow((5.0 + tf.cast(lengths, tf.float32)) / 6.0, length_penalty)
+        normalized = tf.reshape(scores / penalty, (batch_size, beam_size))
+        best = tf.argmax(normalized, axis=-1, output_type=tf.int32) + tf.range(batch_size) * beam_size
+
+        return tf.gather(output, best)
+
+    return decode_beam
+
+@functools.lru_cache(maxsize=None)
+def get_decode_sampled():
+    tokenizer_pt, tokenizer_en = get_tokenizers()
+    return make_decode_sampled(get_transformer(), tokenizer_en.vocab_size, tokenizer_en.vocab_size + 1)
+
+@functools.lru_cache(maxsize=None)
+def get_decode_greedy():
+    tokenizer_pt, tokenizer_en = get_tokenizers()
+    return make_decode_sampled(get_transformer(), tokenizer_en.vocab_size, tokenizer_en.vocab_size + 1,
+            greedy=True)
+
+@functools.lru_cache(maxsize=None)
+def get_decode_beam():
+    tokenizer_pt, tokenizer_en = get_tokenizers()
+    return make_decode_beam(get_transformer(), tokenizer_en.vocab_size, tokenizer_en.vocab_size + 1)
+
+#decodes a (zero padded) batch like decode_batch() with one of DECODE_STRATEGIES,
+#seeds holds one seed per row for 'sample'. strategy=None follows DECODE_STRATEGY
+def decode_with_strategy(encoder_input, strategy=None, seeds=None, max_length=MAX_LENGTH):
+    if strategy is None:
+        strategy = DECODE_STRATEGY
+    encoder_input = tf.cast(encoder_input, tf.int32)
+
+    if strategy == 'greedy':
+        return decode_batch(encoder_input, max_length)
+
+    if strategy == 'sample':
+        if seeds is None:
+            seeds = DECODE_SEED + np.arange(encoder_input.shape[0])
+        return get_decode_sampled()(encoder_input, tf.constant(seeds, dtype=tf.int64), max_length,
+                DECODE_TEMPERATURE, DECODE_TOP_K, DECODE_TOP_P)
+
+    if strategy == 'beam':
+        return get_decode_beam()(encoder_input, max_length, BEAM_SIZE, LENGTH_PENALTY)
+
+    raise ValueError('strategy has to be one of {}'.format(DECODE_STRATEGIES))
+
+def generate_batch(prompts, batch_size=BATCH_SIZE, max_length=MAX_LENGTH, strategy=None, seed=None):
+    #batched version of evaluate(). Returns one result per prompt (in order), each
+    #holding the start token and the predicted ids up to, but not including, the end token.
+    #strategy is one of DECODE_STRATEGIES, prompt i is sampled with the seed seed + i.
+    #None follows DECODE_STRATEGY and DECODE_SEED
+    if seed is None:
+        seed = DECODE_SEED
+    tokenizer_pt, tokenizer_en = get_tokenizers()
+
+    start_token = [tokenizer_pt.vocab_size]
+    end_token = [tokenizer_pt.vocab_size + 1]
+    end_id = tokenizer_en.vocab_size + 1
+
+    results = []
+    for b in range(0, len(prompts), batch_size):
+        encoded = [start_token + tokenizer_pt.encode(p) + end_token
+                for p in prompts[b:b + batch_size]]
+
+        #pad every sentence with 0 up to the longest one, create_padding_mask hides the padding
+        encoder_input = tf.ragged.constant(encoded, dtype=tf.int32).to_tensor() # (batch_size, inp_seq_len)
+        seeds = np.arange(seed + b, seed + b + len(encoded))
+
+        for row in decode_with_strategy(encoder_input, strategy, seeds, max_length).numpy():
+            end = np.flatnonzero(row == end_id)
+            results.append(tf.constant(row[:end[0]] if len(end) else row))
+
+    return results
+
+def translate_batch(sentences, batch_size=BATCH_SIZE, strategy=None, seed=None):
+    tokenizer_pt, tokenizer_en = get_tokenizers()
+    results = generate_batch(sentences, batch_size, strategy=strategy, seed=seed)
+
+    return [tokenizer_en.decode([i for i in result if i < tokenizer_en.vocab_size])
+            for result in results]
+
+'''
+STREAMING GENERATION
+evaluate() stops at MAX_LENGTH because the decoder input (and its cache) keeps growing.
+generate_stream() yields token ids for as long as it's iterated, with a memory footprint
+that doesn't depend on how long the piece gets. The context hops along in windows of
+STREAM_WINDOW tokens, the way the MUSIC_CORPUS examples are laid out: the encoder reads
+the last complete window and the decoder writes the next one with its key/value cache.
+When the decoder has written a full window (or predicts the end token) that window becomes
+the encoder input and the decoder starts over, so neither the cache nor the positions ever
+go past STREAM_WINDOW + 2. Meant for MUSIC_CORPUS, where both sides share one vocabulary.
+'''
+STREAM_WINDOW = MAX_LENGTH - 2
+
+#prompt_ids: token ids without start/end, only the last window of them is used.
+#Stops after max_tokens, or when the decoder predicts the end token right away.
+#strategy is 'greedy' or 'sample' (with the DECODE_* settings and seed). strategy=None follows
+#DECODE_STRATEGY, except that 'beam' streams greedily: a beam only knows its tokens at the end
+def generate_stream(prompt_ids, max_tokens=None, window=STREAM_WINDOW, strategy=None, seed=None):
+    if strategy is None:
+        strategy = 'greedy' if DECODE_STRATEGY == 'beam' else DECODE_STRATEGY
+    if seed is None:
+        seed = DECODE_SEED
+    if strategy not in ('greedy', 'sample'):
+        raise ValueError('generate_stream can only use the greedy or the sample strategy')
+
+    tokenizer_pt, tokenizer_en = get_tokenizers()
+    transformer = get_transformer()
+    seeds = tf.constant([seed], dtype=tf.int64)
+
+    context = [int(i) for i in prompt_ids][-window:]
+    produced = 0
+
+    while max_tokens is None or produced < max_tokens:
+        encoder_input = tf.constant([[tokenizer_pt.vocab_size] + context + [tokenizer_pt.vocab_size + 1]],
+                dtype=tf.int64)
+
+        #a single unpadded sequence, nothing to mask
+        enc_output = transformer.encoder(encoder_input, False, None)
+        cache = transformer.decoder.init_cache(enc_output)
+
+        token = tf.constant([[tokenizer_en.vocab_size]], dtype=tf.int64)
+        written = []
+
+        while len(written) < window and (max_tokens is None or produced < max_tokens):
+            #the cache holds the whole prefix, so the newest token needs no look ahead mask either
+            predictions, _ = transformer.decode(token, enc_output, False, None, None, cache=cache)
+            if strategy == 'sample':
+                logits = filter_logits(predictions[:, -1, :], DECODE_TEMPERATURE, DECODE_TOP_K, DECODE_TOP_P)
+                predicted_id = int(sample_logits(logits, seeds, produced)[0])
+            else:
+                predicted_id = int(tf.argmax(predictions[0, -1]))
+
+            #padding, start or end all close the window
+            if predicted_id == 0 or predicted_id >= tokenizer_en.vocab_size:
+                break
+
+            written.append(predicted_id)
+            produced += 1
+            yield predicted_id
+
+            token = tf.constant([[predicted_id]], dtype=tf.int64)
+
+        if not written:
+            return
+
+        context = written
+
 def plot_attention_weights(attention, sentence, result, layer):
+    import matplotlib.pyplot as plt
+
+    tokenizer_pt, tokenizer_en = get_tokenizers()
+
     fig = plt.figure(figsize=(16,8))
 
     sentence = tokenizer_pt.encode(sentence)
@@ -715,6 +1626,8 @@ def plot_attention_weights(attention, sentence, result, layer):
     plt.show()
 
 def translate(sentence, plot=''):
+    tokenizer_pt, tokenizer_en = get_tokenizers()
+
     result, attention_weights = evaluate(sentence)
 
     predicted_sentence = tokenizer_en.decode([i for i in result
@@ -726,5 +1639,9 @@ def translate(sentence, plot=''):
     if plot:
         plot_attention_weights(attention_weights, sentence, result, plot)
 
-translate("os meus vizinhos ouviram sobre esta ideia", plot='decoder_layer4_block2')
-print("Real translation: my neighboring home heard about this idea.")
+def main():
+    translate("os meus vizinhos ouviram sobre esta ideia", plot='decoder_layer4_block2')
+    print("Real translation: my neighboring home heard about this idea.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import audio_export
+import audio_io
+
+RATE = 8000
+
+def samples(frames=20000, seed=0):
+    return np.random.RandomState(seed).uniform(-1, 1, (frames, 2)).astype(np.float32)
+
+def test_wav_round_trip(tmp_path):
+    x = samples()
+
+    with audio_export.AudioExporter(2) as exporter:
+        path = exporter.submit(str(tmp_path / 'a.wav'), RATE, x, normalized=True).result()
+
+    rate, y = audio_io.load_audio(path)
+    assert rate == RATE
+    assert np.array_equal(y, audio_export.to_pcm16(x, True))
+    assert os.listdir(str(tmp_path)) == ['a.wav']
+
+#the race between writers of the same path doesn't hit every time, so it runs a few rounds
+@pytest.mark.parametrize('round', range(10))
+def test_concurrent_exports_to_one_path(tmp_path, round):
+    path = str(tmp_path / 'same.wav')
+    arrays = [samples(200000, seed=i) for i in range(8)]
+
+    with audio_export.AudioExporter(8) as exporter:
+        futures = [exporter.submit(path, RATE, x, normalized=True) for x in arrays]
+        results = [future.result() for future in futures]
+
+    assert results == [path] * 8
+    assert os.listdir(str(tmp_path)) == ['same.wav']
+    rate, y = audio_io.load_audio(path)
+    assert any(np.array_equal(y, audio_export.to_pcm16(x, True)) for x in arrays)
+
+@pytest.mark.parametrize('dtype', [np.float32, np.int16])
+def test_samples_are_taken_when_submitted(tmp_path, dtype):
+    x = np.ones((1000, 2), dtype=dtype)
+    started = threading.Event()
+
+    with audio_export.AudioExporter(1) as exporter:
+        #keeps the only worker busy until the buffer has been changed
+        exporter.pool.submit(started.wait)
+        future = exporter.submit(str(tmp_path / 'a.wav'), RATE, x)
+        x[:] = 7
+        started.set()
+        path = future.result()
+
+    rate, y = audio_io.load_audio(path)
+    assert np.all(y == 1)
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        audio_export.export(str(tmp_path / 'a.ogg'), RATE, samples())
@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import audio_io
+
+RATE = 44100
+
+#load_mp3 needs pydub and ffmpeg, the cache only cares about what it returns
+@pytest.fixture
+def fake_mp3(monkeypatch):
+    decoded = []
+
+    def load_mp3(path):
+        decoded.append(path)
+        #long enough that concurrent decodes of the same file overlap
+        time.sleep(0.05)
+        with open(path, 'rb') as f:
+            data = np.frombuffer(f.read(), dtype=np.int16)
+        return RATE, data.reshape(-1, 2)
+
+    monkeypatch.setattr(audio_io, 'load_mp3', load_mp3)
+    return decoded
+
+def write_mp3(path, frames, seed=0):
+    data = np.random.RandomState(seed).randint(-2 ** 15, 2 ** 15, (frames, 2)).astype(np.int16)
+    with open(path, 'wb') as f:
+        f.write(data.tobytes())
+    return data
+
+def test_cache_hit_is_memory_mapped(tmp_path, fake_mp3):
+    data = write_mp3(str(tmp_path / 'a.mp3'), 1000)
+    cache_dir = str(tmp_path / 'cache')
+
+    rate, samples = audio_io.load_audio(str(tmp_path / 'a.mp3'), cache_dir=cache_dir)
+    rate, samples = audio_io.load_audio(str(tmp_path / 'a.mp3'), cache_dir=cache_dir)
+
+    assert rate == RATE
+    assert isinstance(samples, np.memmap)
+    assert np.array_equal(samples, data)
+    assert len(fake_mp3) == 1
+
+#the race between workers writing the same cache entry doesn't hit every time, so it runs a few rounds
+@pytest.mark.parametrize('round', range(20))
+def test_same_content_decoded_concurrently(tmp_path, fake_mp3, round):
+    cache_dir = str(tmp_path / 'cache')
+    paths = []
+    for i in range(8):
+        paths.append(str(tmp_path / '{}.mp3'.format(i)))
+        write_mp3(paths[-1], 200000)
+
+    barrier = threading.Barrier(len(paths))
+
+    def cache(path):
+        barrier.wait()
+        return audio_io.cache_mp3(path, cache_dir)
+
+    with ThreadPoolExecutor(len(paths)) as pool:
+        cached = list(pool.map(cache, paths))
+
+    assert len(set(cached)) == 1
+    assert os.listdir(cache_dir) == [os.path.basename(cached[0])]
+    assert np.array_equal(np.load(cached[0]), np.load(cached[0], mmap_mode='r'))
+
+def test_new_entry_larger_than_the_cache_survives_eviction(tmp_path, fake_mp3):
+    cache_dir = str(tmp_path / 'cache')
+    data = write_mp3(str(tmp_path / 'big.mp3'), 10000)
+
+    rate, samples = audio_io.load_mp3_cached(str(tmp_path / 'big.mp3'), cache_dir, max_bytes=100)
+
+    assert np.array_equal(samples, data)
+    assert len(os.listdir(cache_dir)) == 1
+
+def test_bulk_decode_larger_than_the_cache_keeps_its_files(tmp_path, fake_mp3, monkeypatch):
+    #threads, so the workers see the fake decoder
+    monkeypatch.setattr(audio_io, 'ProcessPoolExecutor', ThreadPoolExecutor)
+    cache_dir = str(tmp_path / 'cache')
+
+    old = str(tmp_path / 'old.mp3')
+    write_mp3(old, 1000, seed=10)
+    old_cached = audio_io.cache_mp3(old, cache_dir)
+    os.utime(old_cached, (0, 0))
+
+    paths = [str(tmp_path / '{}.mp3'.format(i)) for i in range(3)]
+    for i, path in enumerate(paths):
+        write_mp3(path, 1000, seed=i)
+
+    cached = audio_io.decode_all(paths, cache_dir, workers=3, max_bytes=10000)
+
+    assert all(os.path.exists(path) for path in cached)
+    assert not os.path.exists(old_cached)
+
+def test_evicts_least_recently_used(tmp_path, fake_mp3):
+    cache_dir = str(tmp_path / 'cache')
+    paths = [str(tmp_path / '{}.mp3'.format(i)) for i in range(3)]
+    for i, path in enumerate(paths):
+        write_mp3(path, 1000, seed=i)
+        audio_io.load_mp3_cached(path, cache_dir)
+    size = os.path.getsize(audio_io.cache_mp3(paths[0], cache_dir))
+
+    #oldest first by mtime: 1, 2, then 0 once it's loaded again
+    for i, path in enumerate(paths):
+        cached = audio_io.cache_mp3(path, cache_dir)
+        os.utime(cached, (i, i))
+    audio_io.load_mp3_cached(paths[0], cache_dir)
+
+    audio_io.evict(cache_dir, 2 * size)
+
+    left = sorted(os.listdir(cache_dir))
+    assert left == sorted(os.path.basename(audio_io.cache_mp3(p, cache_dir)) for p in (paths[0], paths[2]))
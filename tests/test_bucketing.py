@@ -0,0 +1,30 @@
+import os
+
+#model.py is written against the keras 2 api
+os.environ.setdefault('TF_USE_LEGACY_KERAS', '1')
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+import model
+
+def examples(lengths):
+    data = [(np.arange(1, n + 1, dtype=np.int64), np.arange(1, n + 2, dtype=np.int64)) for n in lengths]
+    return tf.data.Dataset.from_generator(lambda: iter(data),
+            output_signature=(tf.TensorSpec([None], tf.int64), tf.TensorSpec([None], tf.int64)))
+
+LENGTHS = np.random.RandomState(0).randint(1, model.MAX_LENGTH, 600)
+
+def test_use_bucketing_set_after_import_is_used(monkeypatch):
+    monkeypatch.setattr(model, 'USE_BUCKETING', True)
+
+    batches = list(model.batch_examples(examples(LENGTHS)))
+
+    assert sum(len(pt) for pt, en in batches) == len(LENGTHS)
+    assert max(len(pt) for pt, en in batches) > model.BATCH_SIZE
+
+def test_bucketing_reduces_padding():
+    before, after = model.report_padding(examples(LENGTHS))
+    assert after < before
@@ -0,0 +1,52 @@
+import os
+import shutil
+
+import pytest
+
+import ingest_midi
+import makeReady
+
+MIDI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'MIDI Files')
+NAMES = ['major-scale.mid', 'mozart.mid', 'test.mid']
+
+#stats of every file on its own, merged
+def file_by_file(store_dir):
+    files, index, shards = ingest_midi.load_corpus(store_dir)
+    stats = makeReady.empty_stats()
+    for file_id in range(len(files)):
+        stats = makeReady.merge_stats(stats, makeReady.compute_stats(ingest_midi.file_events(index, shards, file_id)))
+    return stats
+
+def without_files(stats):
+    return {key: value for key, value in stats.items() if key != 'files'}
+
+@pytest.fixture
+def corpus(tmp_path):
+    midi_dir = tmp_path / 'midi'
+    midi_dir.mkdir()
+    for name in NAMES[:2]:
+        shutil.copy(os.path.join(MIDI_DIR, name), str(midi_dir / name))
+    return str(midi_dir), str(tmp_path / 'store')
+
+#small shards: the first one holds the first two files, the third file gets its own
+def test_corpus_stats_match_the_files(corpus):
+    midi_dir, store_dir = corpus
+    shutil.copy(os.path.join(MIDI_DIR, NAMES[2]), os.path.join(midi_dir, NAMES[2]))
+    ingest_midi.ingest(midi_dir, store_dir, workers=1, shard_size=5000)
+
+    files, index, shards = ingest_midi.load_corpus(store_dir)
+    assert len(files) == len(NAMES) and len(shards) == 2
+
+    assert without_files(makeReady.corpus_stats(store_dir)) == file_by_file(store_dir)
+
+def test_corpus_stats_only_add_the_new_files(corpus):
+    midi_dir, store_dir = corpus
+    ingest_midi.ingest(midi_dir, store_dir, workers=1, shard_size=5000)
+    makeReady.corpus_stats(store_dir)
+
+    shutil.copy(os.path.join(MIDI_DIR, NAMES[2]), os.path.join(midi_dir, NAMES[2]))
+    ingest_midi.ingest(midi_dir, store_dir, workers=1, shard_size=5000)
+    stats = makeReady.corpus_stats(store_dir)
+
+    assert len(stats['files']) == len(NAMES)
+    assert without_files(stats) == file_by_file(store_dir)
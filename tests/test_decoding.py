@@ -0,0 +1,94 @@
+import os
+
+#model.py is written against the keras 2 api
+os.environ.setdefault('TF_USE_LEGACY_KERAS', '1')
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+import model
+
+VOCAB_SIZE = 30
+
+#stands in for both subword tokenizers: one id per character
+class StubTokenizer(object):
+    vocab_size = VOCAB_SIZE
+
+    def encode(self, sentence):
+        return [1 + ord(c) % (VOCAB_SIZE - 1) for c in sentence]
+
+PROMPTS = ['a', 'hello there', 'xyz', 'the quick brown fox', 'ok']
+
+@pytest.fixture
+def small_model(monkeypatch):
+    tf.random.set_seed(0)
+    #start and end tokens come after the vocabulary
+    transformer = model.Transformer(2, 32, 4, 64, VOCAB_SIZE + 2, VOCAB_SIZE + 2,
+            pe_input=VOCAB_SIZE + 2, pe_target=VOCAB_SIZE + 2)
+    tokenizer = StubTokenizer()
+
+    monkeypatch.setattr(model, 'get_tokenizers', lambda: (tokenizer, tokenizer))
+    monkeypatch.setattr(model, 'get_transformer', lambda: transformer)
+
+    #the compiled decoders are memoized with the model they were built for
+    factories = [model.get_decode_greedy, model.get_decode_sampled, model.get_decode_beam]
+    for factory in factories:
+        factory.cache_clear()
+    yield transformer
+    for factory in factories:
+        factory.cache_clear()
+
+@pytest.mark.parametrize('prompt', PROMPTS)
+def test_cached_evaluate_matches_the_full_decoder(small_model, prompt):
+    full, full_attention = model.evaluate(prompt, use_cache=False)
+    cached, cached_attention = model.evaluate(prompt, use_cache=True)
+
+    np.testing.assert_array_equal(cached.numpy(), full.numpy())
+    assert sorted(cached_attention) == sorted(full_attention)
+    for name in full_attention:
+        np.testing.assert_allclose(cached_attention[name], full_attention[name], atol=1e-5)
+
+#the prompts have different lengths, so every batch pads some of them
+def test_generate_batch_matches_evaluate(small_model):
+    results = model.generate_batch(PROMPTS, batch_size=2, strategy='greedy')
+
+    assert len(results) == len(PROMPTS)
+    for prompt, result in zip(PROMPTS, results):
+        expected, _ = model.evaluate(prompt)
+        np.testing.assert_array_equal(result.numpy(), expected.numpy())
+
+#encoder input of the prompts, zero padded like generate_batch() does it
+def encode(prompts):
+    tokenizer = StubTokenizer()
+    encoded = [[VOCAB_SIZE] + tokenizer.encode(p) + [VOCAB_SIZE + 1] for p in prompts]
+    return tf.ragged.constant(encoded, dtype=tf.int32).to_tensor()
+
+#ids up to and including the end token, what comes after it depends on the rest of the batch
+def trim(row):
+    end = np.flatnonzero(row == VOCAB_SIZE + 1)
+    return row[:end[0] + 1] if len(end) else row
+
+def test_sampling_only_depends_on_the_prompt_and_its_seed(small_model):
+    alone = model.decode_with_strategy(encode(PROMPTS[1:2]), 'sample', [10]).numpy()[0]
+    #a seed that samples more than a couple of tokens before the end token
+    assert len(trim(alone)) > 10
+
+    #the same prompt and seed in the middle of a larger batch, next to other prompts and seeds
+    order = [3, 0, 1, 4, 2]
+    seeds = [11, 5, 10, 2, 9]
+    batch = model.decode_with_strategy(encode([PROMPTS[i] for i in order]), 'sample', seeds).numpy()
+
+    np.testing.assert_array_equal(trim(batch[order.index(1)]), trim(alone))
+
+    #and another seed draws something else
+    other = model.decode_with_strategy(encode(PROMPTS[1:2]), 'sample', [14]).numpy()[0]
+    assert not np.array_equal(trim(other), trim(alone))
+
+def test_beam_search_is_deterministic(small_model):
+    encoder_input = encode(PROMPTS)
+
+    first = model.decode_with_strategy(encoder_input, 'beam').numpy()
+    second = model.decode_with_strategy(encoder_input, 'beam').numpy()
+    np.testing.assert_array_equal(first, second)
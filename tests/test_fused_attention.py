@@ -0,0 +1,40 @@
+import os
+
+#model.py is written against the keras 2 api
+os.environ.setdefault('TF_USE_LEGACY_KERAS', '1')
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+import model
+
+VOCAB_SIZE = 40
+
+def small_transformer(fused):
+    return model.Transformer(2, 32, 4, 64, VOCAB_SIZE, VOCAB_SIZE, pe_input=VOCAB_SIZE, pe_target=VOCAB_SIZE,
+            fused=fused)
+
+#a padded batch, so the padding and look ahead masks both matter
+def logits(transformer):
+    inp = tf.constant([[5, 9, 3, 7, 0, 0], [2, 8, 8, 1, 4, 6]])
+    tar = tf.constant([[1, 4, 4, 0], [3, 2, 7, 9]])
+
+    enc_padding_mask, combined_mask, dec_padding_mask = model.create_masks(inp, tar)
+    output, _ = transformer(inp, tar, False, enc_padding_mask, combined_mask, dec_padding_mask)
+    return output.numpy()
+
+def test_fused_model_restores_an_unfused_checkpoint(tmp_path):
+    tf.random.set_seed(0)
+    unfused = small_transformer(fused=False)
+    expected = logits(unfused)
+    path = tf.train.Checkpoint(transformer=unfused).save(str(tmp_path / 'ckpt'))
+
+    fused = small_transformer(fused=True)
+    status = tf.train.Checkpoint(transformer=fused).restore(path)
+    restored = logits(fused)
+
+    #every variable of the checkpoint found its place in the fused model
+    status.assert_consumed()
+    np.testing.assert_allclose(restored, expected, atol=1e-5)
@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+import pytest
+
+import midi_events
+
+MIDI_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'MIDI Files')
+
+#delta times on both sides of every variable length quantity byte boundary
+VLQ_DELTAS = [0, 1, 127, 128, 129, 16383, 16384, 2 ** 21 - 1, 2 ** 21, 2 ** 28 - 1]
+
+def assert_same(a, b):
+    assert a.ticks_per_beat == b.ticks_per_beat
+    assert np.array_equal(a.events, b.events)
+    assert np.array_equal(a.tempos, b.tempos)
+
+def make_midi(deltas, track=0):
+    events = np.zeros(len(deltas), dtype=midi_events.EVENT_DTYPE)
+    events['track'] = track
+    events['type'] = np.arange(len(deltas)) % 2 == 0
+    events['channel'] = np.arange(len(deltas)) % 16
+    events['note'] = 60 + np.arange(len(deltas)) % 12
+    events['velocity'] = 100
+    events['delta'] = deltas
+    events['tick'] = np.cumsum(deltas)
+
+    tempos = np.array([(0, midi_events.DEFAULT_TEMPO)], dtype=midi_events.TEMPO_DTYPE)
+    return midi_events.Midi(events, 480, tempos)
+
+def one_track_file(body):
+    header = b'MThd' + (6).to_bytes(4, 'big') + (0).to_bytes(2, 'big') + (1).to_bytes(2, 'big') + (96).to_bytes(2, 'big')
+    body += midi_events.END_OF_TRACK
+    return header + b'MTrk' + len(body).to_bytes(4, 'big') + body
+
+#sequencers keep the running status going across meta and sysex events
+@pytest.mark.parametrize('between', [
+    b'\x00\xFF\x01\x03abc',  # text meta event
+    b'\x00\xF0\x03\x7E\x7F\xF7',  # sysex
+])
+def test_running_status_after_meta_and_sysex(between):
+    data = one_track_file(b'\x00\x91\x3C\x64' + between + b'\x10\x3E\x50' + b'\x10\x3C\x00')
+
+    events = midi_events.parse_midi(data).events
+
+    assert events['type'].tolist() == [midi_events.NOTE_ON, midi_events.NOTE_ON, midi_events.NOTE_OFF]
+    assert events['channel'].tolist() == [1, 1, 1]
+    assert events['note'].tolist() == [60, 62, 60]
+    assert events['tick'].tolist() == [0, 16, 32]
+
+def test_running_status_without_any_status_byte():
+    with pytest.raises(midi_events.MidiFormatError):
+        midi_events.parse_midi(one_track_file(b'\x00\xFF\x01\x01a' + b'\x00\x3C\x64'))
+
+@pytest.mark.parametrize('name', ['major-scale.mid', 'mozart.mid', 'test.mid'])
+def test_round_trip_of_the_repo_files(name):
+    midi = midi_events.read_midi(os.path.join(MIDI_DIR, name))
+    assert len(midi.events)
+
+    assert_same(midi_events.parse_midi(midi_events.encode_midi(midi)), midi)
+
+def test_round_trip_of_every_varlen_size():
+    midi = make_midi(VLQ_DELTAS)
+
+    assert_same(midi_events.parse_midi(midi_events.encode_midi(midi)), midi)
+
+@pytest.mark.parametrize('delta', VLQ_DELTAS)
+def test_varlen_bytes(delta):
+    messages = np.zeros((1, midi_events.MESSAGE_WIDTH), dtype=np.uint8)
+    messages[0, :3] = (0x90, 60, 100)
+    chunk = midi_events.pack_track(np.array([delta]), messages, np.array([3]))
+
+    value, pos = midi_events.read_varlen(chunk, 8)
+    assert value == delta
+    #the shortest encoding, then the message
+    assert pos - 8 == max(1, (delta.bit_length() + 6) // 7)
+    assert chunk[pos:pos + 3] == b'\x90\x3c\x64'
+
+def test_tempo_changes_and_several_tracks():
+    first = make_midi([0, 10, 20])
+    second = make_midi([5, 300, 70000], track=2)
+    events = np.concatenate([first.events, second.events])
+    tempos = np.array([(0, 400000), (15, 600000), (1000, 250000)], dtype=midi_events.TEMPO_DTYPE)
+    midi = midi_events.Midi(events, 96, tempos)
+
+    parsed = midi_events.parse_midi(midi_events.encode_midi(midi))
+
+    assert_same(parsed, midi)
+    assert set(parsed.events['track']) == {0, 2}
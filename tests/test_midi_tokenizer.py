@@ -0,0 +1,40 @@
+import os
+import shutil
+
+import numpy as np
+
+import ingest_midi
+import midi_events
+import midi_tokenizer
+
+MIDI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'MIDI Files')
+NAMES = ['major-scale.mid', 'mozart.mid', 'test.mid']
+WINDOW = 32
+
+#the files spread over several shards, every other one goes to validation
+def test_corpus_windows_follow_each_file(tmp_path):
+    midi_dir = tmp_path / 'midi'
+    midi_dir.mkdir()
+    for name in NAMES:
+        shutil.copy(os.path.join(MIDI_DIR, name), str(midi_dir / name))
+    store_dir = str(tmp_path / 'store')
+    ingest_midi.ingest(str(midi_dir), store_dir, workers=1, shard_size=5000)
+
+    tokenizer = midi_tokenizer.MidiTokenizer()
+    (train_inp, train_tar), (val_inp, val_tar) = midi_tokenizer.corpus_windows(store_dir, tokenizer, WINDOW, 2)
+
+    #the same windows, from each file read through file_events
+    files, index, shards = ingest_midi.load_corpus(store_dir)
+    expected = ([], []), ([], [])
+    for file_id, entry in enumerate(files):
+        tempos = np.array([tuple(t) for t in entry['tempos']], dtype=midi_events.TEMPO_DTYPE)
+        midi = midi_events.Midi(ingest_midi.file_events(index, shards, file_id), entry['ticks_per_beat'], tempos)
+        windows = midi_tokenizer.split_windows(tokenizer.encode_array(midi), WINDOW, tokenizer)
+        inp, tar = expected[file_id % 2 == 0]
+        inp.append(windows[:-1])
+        tar.append(windows[1:])
+
+    for arrays, (inp, tar) in zip([(train_inp, train_tar), (val_inp, val_tar)], expected):
+        assert len(arrays[0]) > 0
+        np.testing.assert_array_equal(arrays[0], np.concatenate(inp))
+        np.testing.assert_array_equal(arrays[1], np.concatenate(tar))
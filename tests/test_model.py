@@ -0,0 +1,64 @@
+import os
+
+#model.py is written against the keras 2 api
+os.environ.setdefault('TF_USE_LEGACY_KERAS', '1')
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+import model
+
+def examples(lengths):
+    data = [(np.arange(1, n + 1, dtype=np.int64), np.arange(1, n + 2, dtype=np.int64)) for n in lengths]
+    return tf.data.Dataset.from_generator(lambda: iter(data),
+            output_signature=(tf.TensorSpec([None], tf.int64), tf.TensorSpec([None], tf.int64)))
+
+LENGTHS = np.random.RandomState(0).randint(1, model.MAX_LENGTH, 600)
+
+def test_token_budget_is_never_exceeded(monkeypatch):
+    monkeypatch.setattr(model, 'TOKEN_BUDGET', 256)
+
+    batches = list(model.batch_examples(examples(LENGTHS)))
+
+    assert sum(len(pt) for pt, en in batches) == len(LENGTHS)
+    for pt, en in batches:
+        assert tf.size(pt) <= 256 and tf.size(en) <= 256
+
+def test_token_budget_set_after_import_is_used(monkeypatch):
+    monkeypatch.setattr(model, 'TOKEN_BUDGET', 200)
+    monkeypatch.setattr(model, 'TOKEN_BUDGET_BOUNDARIES', [20])
+
+    sizes = set(len(pt) for pt, en in model.batch_examples(examples(LENGTHS)))
+    assert max(sizes) == 200 // 19
+
+def test_accumulated_gradients_are_the_mean_of_the_batches():
+    tf.random.set_seed(0)
+    transformer = model.Transformer(1, 16, 2, 32, 50, 50, pe_input=50, pe_target=50, rate=0.0)
+    optimizer = tf.keras.optimizers.SGD(1.0)
+    metrics = tf.keras.metrics.Mean(), tf.keras.metrics.SparseCategoricalAccuracy()
+
+    rng = np.random.RandomState(1)
+    batches = [(tf.constant(rng.randint(1, 50, (4, 9))), tf.constant(rng.randint(1, 50, (4, 11))))
+            for _ in range(3)]
+
+    train_step = model.make_train_step(transformer, optimizer, *metrics, accumulation_steps=3)
+    #builds the variables before they are copied
+    transformer(batches[0][0], batches[0][1][:, :-1], False, None, None, None)
+    before = [v.numpy() for v in transformer.trainable_variables]
+
+    expected = [np.zeros_like(v) for v in before]
+    for inp, tar in batches:
+        with tf.GradientTape() as tape:
+            masks = model.create_masks(inp, tar[:, :-1])
+            predictions, _ = transformer(inp, tar[:, :-1], True, *masks)
+            loss = model.loss_function(tar[:, 1:], predictions)
+        for e, g in zip(expected, tape.gradient(loss, transformer.trainable_variables)):
+            e += tf.convert_to_tensor(g).numpy() / len(batches)
+
+    for inp, tar in batches:
+        train_step(inp, tar)
+
+    for b, v, e in zip(before, transformer.trainable_variables, expected):
+        np.testing.assert_allclose(b - v.numpy(), e, atol=1e-6)
@@ -0,0 +1,37 @@
+import os
+
+#model.py is written against the keras 2 api
+os.environ.setdefault('TF_USE_LEGACY_KERAS', '1')
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+import model
+
+def test_positional_encoding_in_a_graph_matches_the_table():
+    @tf.function(input_signature=[tf.TensorSpec([], tf.int32), tf.TensorSpec([], tf.int32)])
+    def encoding(start, length):
+        return model.get_positional_encoding(length, 16, start)
+
+    table = model.positional_encoding(4 * model.MAX_LENGTH, 16).numpy()
+    for start, length in [(0, 10), (7, 30), (0, 4 * model.MAX_LENGTH)]:
+        np.testing.assert_allclose(encoding(start, length), table[:, start:start + length], atol=1e-6)
+
+def test_graph_reuses_the_table():
+    @tf.function(input_signature=[tf.TensorSpec([], tf.int32)])
+    def encoding(length):
+        return model.get_positional_encoding(length, 24)
+
+    graph = encoding.get_concrete_function().graph
+    #the sines and cosines are only computed in the branch for positions past the table
+    assert not [op for op in graph.get_operations() if op.type in ('Sin', 'Cos')]
+    assert model.pos_encoding_tables[24].shape[1] >= model.POSITION_TABLE_LENGTH
+
+def test_static_lengths_grow_the_table():
+    model.get_positional_encoding(3 * model.POSITION_TABLE_LENGTH, 8)
+    table = model.pos_encoding_tables[8]
+
+    assert table.shape[1] >= 3 * model.POSITION_TABLE_LENGTH
+    np.testing.assert_allclose(model.get_positional_encoding(5, 8, start=2), table[:, 2:7])
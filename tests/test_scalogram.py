@@ -0,0 +1,34 @@
+import numpy as np
+import pywt
+
+import wavelets
+
+def signal(length, seed=0):
+    return np.random.RandomState(seed).randn(length)
+
+def test_scalogram_image_keeps_the_peaks():
+    coeffs = pywt.wavedec(signal(4096), 'haar', level=4)
+    coeffs[-1][1234] = 100.0
+
+    image = wavelets.scalogram_image(coeffs, width=256, height=64)
+
+    #cD_1 is the top row band, cA_n the bottom one
+    assert image.shape[1] == 256
+    assert image[0].max() == 100.0
+    assert np.all(image >= 0)
+
+def test_scalogram_rows_and_short_levels():
+    coeffs = pywt.wavedec(signal(64), 'haar', level=3)
+
+    image = wavelets.scalogram_image(coeffs, width=32, height=16)
+
+    #every level twice as tall as the one below it: 1, 2, 4 and 8 of the 16 rows
+    assert image.shape == (15, 32)
+    #a level with fewer coefficients than pixels repeats every coefficient
+    np.testing.assert_array_equal(image[-1], np.repeat(np.abs(coeffs[0]), 32 // len(coeffs[0])))
+
+def test_save_scalogram_npy(tmp_path):
+    image = wavelets.scalogram_image(pywt.wavedec(signal(256), 'db2', level=3), width=16, height=8)
+    path = wavelets.save_scalogram(image, str(tmp_path / 'image.npy'))
+
+    np.testing.assert_array_equal(np.load(path), image)
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+import pywt
+import scipy.io.wavfile as wavfile
+
+import wavelets
+
+WAVELETS = ['haar', 'db4', 'sym5', 'coif3']
+LENGTHS = [64, 100, 1001, 4096]
+BLOCK_SIZES = [1, 7, 64, 1000, 5000]
+
+def signal(length, seed=0):
+    return np.random.RandomState(seed).randn(length)
+
+def blocks(x, size):
+    return (x[i:i + size] for i in range(0, len(x), size))
+
+def assert_coefficients(got, expected):
+    assert len(got) == len(expected)
+    for g, e in zip(got, expected):
+        assert g.shape == e.shape
+        np.testing.assert_allclose(g, e, rtol=0, atol=1e-10)
+
+@pytest.mark.parametrize('mode', wavelets.BLOCK_MODES)
+@pytest.mark.parametrize('wavelet', WAVELETS)
+@pytest.mark.parametrize('length', LENGTHS)
+def test_wavedec_blocks_matches_pywt(mode, wavelet, length):
+    x = signal(length)
+    expected = pywt.wavedec(x, wavelet, mode)
+
+    for size in BLOCK_SIZES:
+        got = wavelets.wavedec_blocks(blocks(x, size), length, wavelet, mode=mode, pad=False)
+        assert_coefficients(got, expected)
+
+@pytest.mark.parametrize('mode', wavelets.BLOCK_MODES)
+def test_padding_matches_pywt_on_the_padded_signal(mode):
+    x = signal(1000)
+    level = 5
+    padded = np.concatenate([x, np.zeros(-len(x) % 2 ** level)])
+
+    got = wavelets.wavedec_blocks(blocks(x, 128), len(x), 'db2', level, mode)
+
+    assert_coefficients(got, pywt.wavedec(padded, 'db2', mode, level))
+
+@pytest.mark.parametrize('mode', wavelets.BLOCK_MODES)
+def test_signal_shorter_than_the_filter(mode):
+    x = signal(5)
+
+    dwt = wavelets.DWTLevel('db4', mode)
+    cA, cD = dwt.push(x)
+    cA_end, cD_end = dwt.flush()
+
+    expected = pywt.dwt(x, 'db4', mode)
+    np.testing.assert_allclose(np.concatenate([cA, cA_end]), expected[0])
+    np.testing.assert_allclose(np.concatenate([cD, cD_end]), expected[1])
+
+def test_wavedec_file_matches_pywt(tmp_path):
+    path = str(tmp_path / 'test.wav')
+    x = (signal(30000, seed=1) * 3000).astype(np.int16)
+    wavfile.write(path, 8000, np.stack([x, -x], axis=1))
+
+    got = wavelets.wavedec_file(path, 'sym5', level=4, channel=1, pad=False, block_frames=4096)
+
+    assert_coefficients(got, pywt.wavedec(-x.astype(np.float64), 'sym5', 'symmetric', 4))
@@ -0,0 +1,178 @@
+'''
+TOKENIZER BUILD
+Builds the portuguese and english subword tokenizers used by model.py.
+
+SubwordTextEncoder.build_from_corpus() counts the corpus in python, one language after
+the other. Here both languages are counted in a single pass over the examples, the
+counting of each chunk of sentences is done on a process pool and the partial counts are
+checkpointed after every chunk, so an interrupted build resumes where it stopped.
+The vocabularies are then built from the merged counts with the same search as
+build_from_corpus() and written to the same tokenized_pt/tokenized_en files.
+
+Run on its own with: python tokenizer_build.py
+'''
+import collections
+import multiprocessing
+import os
+import pickle
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import tensorflow_datasets as tfds
+
+SubwordTextEncoder = tfds.features.text.SubwordTextEncoder
+#the module holding the counting helper used by build_from_corpus()
+subword_module = sys.modules[SubwordTextEncoder.__module__]
+
+TARGET_VOCAB_SIZE = 2**13
+CHUNK_SIZE = 5000
+COUNTS_CHECKPOINT = 'tokenizer_counts.pkl'
+#upper bound of the default number of counting workers
+MAX_WORKERS = 4
+
+#spawn, not fork: tfds has already started TensorFlow's threads in this process and forking
+#a process with running threads can deadlock the children. Spawned workers import this
+#module on their own, and with it tensorflow_datasets and TensorFlow, which takes a few
+#seconds and several hundred MB per worker. That's why the pools are kept small (MAX_WORKERS)
+#and live for the whole count instead of one per chunk
+pool_context = multiprocessing.get_context('spawn')
+
+#worker: token counts of one chunk of sentences for both languages
+def count_chunk(chunk):
+    pt_sentences, en_sentences = chunk
+
+    pt_counts = subword_module._token_counts_from_generator(
+            generator=pt_sentences, max_chars=None, reserved_tokens=[])
+    en_counts = subword_module._token_counts_from_generator(
+            generator=en_sentences, max_chars=None, reserved_tokens=[])
+
+    return dict(pt_counts), dict(en_counts)
+
+#group the (pt, en) examples into chunks of raw byte strings that can be sent to the workers
+def chunk_examples(examples, chunk_size=CHUNK_SIZE):
+    pt_sentences, en_sentences = [], []
+    for pt, en in examples:
+        pt_sentences.append(pt.numpy())
+        en_sentences.append(en.numpy())
+
+        if len(pt_sentences) == chunk_size:
+            yield pt_sentences, en_sentences
+            pt_sentences, en_sentences = [], []
+
+    if pt_sentences:
+        yield pt_sentences, en_sentences
+
+def load_counts(path=COUNTS_CHECKPOINT, chunk_size=CHUNK_SIZE):
+    state = {'chunk_size': chunk_size, 'chunks': 0, 'sentences': 0,
+            'pt': collections.Counter(), 'en': collections.Counter()}
+
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+
+        #counts made with another chunk size can't be resumed from
+        if saved['chunk_size'] == chunk_size:
+            state = saved
+            print('Resuming tokenizer counts after {} sentences'.format(state['sentences']))
+
+    return state
+
+#written to a temporary file first so an interrupted save never leaves a broken checkpoint
+def save_counts(state, path=COUNTS_CHECKPOINT):
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+#counts both languages of the (pt, en) examples, resuming from the checkpoint if there is one
+def count_corpus(examples, workers=None, chunk_size=CHUNK_SIZE, checkpoint=COUNTS_CHECKPOINT):
+    state = load_counts(checkpoint, chunk_size)
+    workers = workers or min(os.cpu_count(), MAX_WORKERS)
+    start = time.time()
+
+    chunks = chunk_examples(examples.skip(state['chunks'] * chunk_size), chunk_size)
+
+    with ProcessPoolExecutor(workers, mp_context=pool_context) as pool:
+        pending = collections.deque()
+
+        for chunk in chunks:
+            pending.append((len(chunk[0]), pool.submit(count_chunk, chunk)))
+
+            #keep a bounded number of chunks in flight and merge them in order,
+            #so the checkpoint always covers a prefix of the corpus
+            while len(pending) > 2 * workers:
+                merge_chunk(state, *pending.popleft(), checkpoint=checkpoint, start=start)
+
+        while pending:
+            merge_chunk(state, *pending.popleft(), checkpoint=checkpoint, start=start)
+
+    return state['pt'], state['en']
+
+def merge_chunk(state, num_sentences, future, checkpoint, start):
+    pt_counts, en_counts = future.result()
+
+    state['pt'].update(pt_counts)
+    state['en'].update(en_counts)
+    state['chunks'] += 1
+    state['sentences'] += num_sentences
+    save_counts(state, checkpoint)
+
+    print('Counted {} sentences ({:.1f} secs)'.format(state['sentences'], time.time() - start))
+
+#same binary search over the minimum token count as SubwordTextEncoder.build_from_corpus()
+def build_from_token_counts(token_counts, target_vocab_size=TARGET_VOCAB_SIZE, max_subword_length=20):
+    low = max(min(token_counts.values()), 1)
+    high = max(token_counts.values())
+    best = None
+
+    while True:
+        candidate_min = (low + high) // 2
+        encoder = SubwordTextEncoder._build_from_token_counts(
+                token_counts=token_counts,
+                min_token_count=candidate_min,
+                reserved_tokens=[],
+                num_iterations=4,
+                max_subword_length=max_subword_length)
+        vocab_size = encoder.vocab_size
+        print('Trying min_token_count {} -> vocab size {}'.format(candidate_min, vocab_size))
+
+        #keep the one that's closest to the target, the later one wins a tie
+        if best is None or abs(vocab_size - target_vocab_size) <= abs(best.vocab_size - target_vocab_size):
+            best = encoder
+
+        #being within 1% of the target vocab size is ok
+        if (abs(vocab_size - target_vocab_size) * 100 < target_vocab_size
+                or low >= high or candidate_min <= 1):
+            return best
+
+        if vocab_size > target_vocab_size:
+            low = candidate_min + 1
+        else:
+            high = candidate_min - 1
+
+#worker: build one vocabulary and save it
+def build_and_save(token_counts, prefix, target_vocab_size=TARGET_VOCAB_SIZE):
+    encoder = build_from_token_counts(token_counts, target_vocab_size)
+    encoder.save_to_file(prefix)
+    return prefix
+
+def build_tokenizers(examples, target_vocab_size=TARGET_VOCAB_SIZE, workers=None):
+    pt_counts, en_counts = count_corpus(examples, workers)
+
+    #the two vocabularies are independent, so build them side by side
+    with ProcessPoolExecutor(2, mp_context=pool_context) as pool:
+        builds = [pool.submit(build_and_save, dict(pt_counts), 'tokenized_pt', target_vocab_size),
+                pool.submit(build_and_save, dict(en_counts), 'tokenized_en', target_vocab_size)]
+        for build in builds:
+            build.result()
+
+    #the counts are no longer needed once both tokenizers are written
+    if os.path.exists(COUNTS_CHECKPOINT):
+        os.remove(COUNTS_CHECKPOINT)
+
+    return (SubwordTextEncoder.load_from_file('tokenized_pt'),
+            SubwordTextEncoder.load_from_file('tokenized_en'))
+
+if __name__ == '__main__':
+    examples = tfds.load('ted_hrlr_translate/pt_to_en', as_supervised=True)
+    build_tokenizers(examples['train'])
@@ -0,0 +1,91 @@
+'''
+TRAINING BENCHMARK
+Steps per second and peak memory of the transformer's train_step on the CPU, for every
+combination of XLA (jit_compile) and compute precision, with the hyperparameters from
+model.py (num_layers=4, d_model=128, dff=512, num_heads=8). The batches are random
+token ids of BATCH_SIZE x SEQ_LEN, the size of a full batch of the filtered dataset.
+Every combination runs in a fresh process, so each one gets its own precision policy
+and peak memory reading.
+
+Run with: python train_benchmark.py [steps]
+'''
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+PRECISIONS = ['float32', 'mixed_bfloat16', 'mixed_float16']
+JIT_COMPILE = [False, True]
+
+BATCH_SIZE = 64
+SEQ_LEN = 40
+VOCAB_SIZE = 2**13 + 2
+WARMUP_STEPS = 3
+
+#worker: time `steps` train steps in one configuration, returns (steps per sec, peak MB)
+def run_benchmark(precision, jit_compile, steps):
+    #CPU only
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    import numpy as np
+    import tensorflow as tf
+    import model
+
+    tf.keras.mixed_precision.set_global_policy(precision)
+
+    transformer = model.Transformer(model.num_layers, model.d_model, model.num_heads, model.dff,
+            VOCAB_SIZE, VOCAB_SIZE, pe_input=VOCAB_SIZE, pe_target=VOCAB_SIZE,
+            rate=model.dropout_rate, fused=model.use_fused_attention)
+    optimizer = model.create_optimizer(precision)
+    train_loss = tf.keras.metrics.Mean(name='train_loss')
+    train_accuracy = tf.keras.metrics.SparseCategoricalAccuracy(name='train_accuracy')
+
+    train_step = model.make_train_step(transformer, optimizer, train_loss, train_accuracy,
+            jit_compile=jit_compile)
+
+    #random sentences with some padding at the end, like a padded batch
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(SEQ_LEN // 2, SEQ_LEN + 1, size=(2, BATCH_SIZE))
+    inp, tar = [tf.constant(np.where(np.arange(SEQ_LEN) < length[:, np.newaxis],
+            rng.integers(1, VOCAB_SIZE, size=(BATCH_SIZE, SEQ_LEN)), 0), dtype=tf.int64)
+            for length in lengths]
+
+    #the first steps trace (and with XLA compile) the step
+    for _ in range(WARMUP_STEPS):
+        train_step(inp, tar)
+    train_loss.result().numpy()
+
+    start = time.time()
+    for _ in range(steps):
+        train_step(inp, tar)
+    #wait for the last step to finish
+    train_loss.result().numpy()
+    elapsed = time.time() - start
+
+    #ru_maxrss is in kilobytes on linux
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return steps / elapsed, peak_mb
+
+def benchmark(steps=20):
+    results = []
+    context = multiprocessing.get_context('spawn')
+
+    for jit_compile in JIT_COMPILE:
+        for precision in PRECISIONS:
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                try:
+                    steps_per_sec, peak_mb = pool.submit(run_benchmark, precision, jit_compile, steps).result()
+                except Exception as e:
+                    print('{:<16} jit={:<5} failed: {}'.format(precision, str(jit_compile), e))
+                    continue
+
+            print('{:<16} jit={:<5} {:7.2f} steps/sec {:9.1f} MB peak'.format(
+                    precision, str(jit_compile), steps_per_sec, peak_mb))
+            results.append((precision, jit_compile, steps_per_sec, peak_mb))
+
+    return results
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,145 @@
+'''
+WAVELET FEATURE EXTRACTION
+Runs the wavelet decomposition (wavelets.wavedec_file) over every .wav/.mp3 of a directory
+on a process pool, for any number of wavelets, levels and channels at once. The
+coefficients are cached on disk, one .npz per (file hash, wavelet, mode, level, channel):
+
+    <cache>/<sha1 of the file>/<wavelet>-<mode>-L<level>-c<channel>.npz
+
+so running the same analysis again, adding files or sweeping over more parameters only
+computes the decompositions that aren't in the cache yet. level 'max' is the deepest level
+pywt allows for the file. hashes.json remembers the hash of every file with its mtime and
+size, so unchanged files aren't read again just to be hashed.
+
+Run with: python wavelet_features.py <audio file or directory> <cache directory> <wavelet>[,<wavelet>...] [level] [channel]
+'''
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import audio_io
+import wavelets
+
+AUDIO_EXTENSIONS = ('.wav', '.mp3')
+
+def find_audio_files(audio_dir):
+    paths = []
+    for root, dirs, files in os.walk(audio_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(AUDIO_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+    return paths
+
+#sha1 of every path, only hashing the files whose mtime or size changed since the last run
+def file_hashes(paths, cache_dir):
+    index_path = os.path.join(cache_dir, 'hashes.json')
+    known = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            known = json.load(f)
+
+    hashes = []
+    for path in paths:
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        entry = known.get(key)
+
+        if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+            entry = {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': audio_io.hash_file(path)}
+            known[key] = entry
+        hashes.append(entry['sha1'])
+
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(known, f)
+    os.replace(index_path + '.tmp', index_path)
+
+    return hashes
+
+def cache_path(cache_dir, sha1, wavelet, level, channel, mode='symmetric'):
+    name = '{}-{}-L{}-c{}.npz'.format(wavelet, mode, 'max' if level is None else level, channel)
+    return os.path.join(cache_dir, sha1, name)
+
+#worker: decompose one channel of one file and write it to the cache. Returns (out_path, error)
+def extract(path, out_path, wavelet, level, channel, mode='symmetric'):
+    try:
+        coeffs = wavelets.wavedec_file(path, wavelet, level, channel, mode)
+
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        #written under another name first, so the cache never holds a half written file
+        tmp_path = out_path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, *coeffs)
+        os.replace(tmp_path, out_path)
+
+        return out_path, None
+    except Exception as e:
+        return out_path, '{}: {}'.format(type(e).__name__, e)
+
+#[cA_n, cD_n, ..., cD_1] of a cached decomposition, as written by extract()
+def load_coefficients(path):
+    with np.load(path) as data:
+        return [data['arr_{}'.format(i)] for i in range(len(data.files))]
+
+#decomposes every file for every combination of wavelets, levels and channels. Returns
+#{(path, wavelet, level, channel): cache file}, the failed ones are left out
+def extract_features(paths, cache_dir, wavelet_names, levels=(None,), channels=(0,), mode='symmetric',
+        workers=None):
+    start = time.time()
+    os.makedirs(cache_dir, exist_ok=True)
+
+    results = {}
+    #files with the same content share their cache entries, so they are only computed once
+    jobs = {}
+    for path, sha1 in zip(paths, file_hashes(paths, cache_dir)):
+        for wavelet, level, channel in itertools.product(wavelet_names, levels, channels):
+            key = (path, wavelet, level, channel)
+            out_path = cache_path(cache_dir, sha1, wavelet, level, channel, mode)
+
+            if os.path.exists(out_path):
+                results[key] = out_path
+            else:
+                jobs.setdefault(out_path, []).append(key)
+
+    print('{} decompositions cached, {} to compute'.format(len(results), len(jobs)))
+
+    failed = 0
+    if jobs:
+        out_paths = list(jobs)
+        with ProcessPoolExecutor(workers) as pool:
+            done = pool.map(extract,
+                    [jobs[out_path][0][0] for out_path in out_paths],
+                    out_paths,
+                    [jobs[out_path][0][1] for out_path in out_paths],
+                    [jobs[out_path][0][2] for out_path in out_paths],
+                    [jobs[out_path][0][3] for out_path in out_paths],
+                    [mode] * len(out_paths))
+
+            for out_path, error in done:
+                if error is not None:
+                    print('Skipping {} ({})'.format(jobs[out_path][0], error))
+                    failed += 1
+                    continue
+                for key in jobs[out_path]:
+                    results[key] = out_path
+
+    print('Computed {} decompositions ({} failed) in {:.1f} secs'.format(
+            len(jobs) - failed, failed, time.time() - start))
+    return results
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print('usage: python wavelet_features.py <audio file or directory> <cache directory> '
+                '<wavelet>[,<wavelet>...] [level] [channel]')
+        sys.exit(1)
+
+    source = sys.argv[1]
+    paths = find_audio_files(source) if os.path.isdir(source) else [source]
+    levels = [int(sys.argv[4])] if len(sys.argv) > 4 else [None]
+    channels = [int(sys.argv[5])] if len(sys.argv) > 5 else [0]
+
+    extract_features(paths, sys.argv[2], sys.argv[3].split(','), levels, channels)
@@ -0,0 +1,134 @@
+'''
+STREAMING WAVELET ANALYSIS
+Analyzes audio while it comes in instead of after the whole file is loaded. The frames come
+from any iterable of sample arrays: file_frames() reads them from a file (optionally at real
+time speed, to stand in for a live source) and RingBuffer lets another thread (a renderer,
+a sound card callback) push samples that are read back as frames.
+
+StreamingAnalyzer keeps the filter state of every level (see wavelets.BlockDWT), so each
+frame only costs the coefficients it completes. For every frame it emits the energy (mean
+square coefficient) of every level, in wavedec order [cA_n, cD_n, ..., cD_1]. A level only
+has new coefficients once enough samples reached it: level l lags by about
+dec_len * 2**l samples, and levels without new coefficients report nan for that frame.
+
+Run with: python wavelet_stream.py <audio file> [wavelet] [level] [--realtime]
+'''
+import sys
+import threading
+import time
+
+import numpy as np
+
+import audio_io
+import wavelets
+
+FRAME_SIZE = 1024
+
+class StreamingAnalyzer(object):
+    def __init__(self, wavelet='db4', level=6, mode='zero'):
+        self.level = level
+        self.dwt = wavelets.BlockDWT(wavelet, level, mode)
+        self.samples = 0
+
+    @staticmethod
+    def energies(approx, details):
+        levels = [approx] + details[::-1]
+        return np.array([np.mean(np.square(c)) if len(c) else np.nan for c in levels])
+
+    #(samples seen so far, energies) after one more frame
+    def push(self, frame):
+        self.samples += len(frame)
+        return self.samples, self.energies(*self.dwt.push(frame))
+
+    #the energies of the coefficients that were still waiting on the end of the signal
+    def flush(self):
+        return self.samples, self.energies(*self.dwt.flush())
+
+#yields (seconds of audio seen, energies) for every frame, and for the flush at the end
+def analyze(frames, rate, wavelet='db4', level=6, mode='zero'):
+    analyzer = StreamingAnalyzer(wavelet, level, mode)
+
+    for frame in frames:
+        samples, energies = analyzer.push(frame)
+        yield samples / float(rate), energies
+
+    samples, energies = analyzer.flush()
+    yield samples / float(rate), energies
+
+#frames of one channel of a file (float32 in [-1, 1]). With realtime every frame is only
+#handed out once it would have been played, like a live input
+def file_frames(path, frame_size=FRAME_SIZE, channel=0, realtime=False):
+    rate, _ = audio_io.load_audio(path)
+    start = time.time()
+    played = 0
+
+    for frame in audio_io.iter_blocks(path, frame_size, channel=channel, normalized=True):
+        played += len(frame)
+        if realtime:
+            time.sleep(max(0.0, played / float(rate) - (time.time() - start)))
+        yield frame
+
+#a fixed size buffer between a thread that writes samples and one that reads frames. When
+#the reader falls behind by more than the capacity the oldest samples are dropped, so the
+#writer never blocks and memory stays bounded
+class RingBuffer(object):
+    def __init__(self, capacity, dtype=np.float32):
+        self.buffer = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        self.written = 0
+        self.read = 0
+        self.dropped = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def write(self, samples):
+        samples = np.asarray(samples, dtype=self.buffer.dtype)
+        count = len(samples)
+        #only the last capacity samples of a large write can be kept anyway
+        samples = samples[max(0, count - self.capacity):]
+
+        with self.condition:
+            start = (self.written + count - len(samples)) % self.capacity
+            first = min(len(samples), self.capacity - start)
+            self.buffer[start:start + first] = samples[:first]
+            self.buffer[:len(samples) - first] = samples[first:]
+            self.written += count
+
+            if self.written - self.read > self.capacity:
+                self.dropped += self.written - self.capacity - self.read
+                self.read = self.written - self.capacity
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    #yields frames of frame_size samples until the buffer is closed (the last one can be shorter)
+    def frames(self, frame_size=FRAME_SIZE):
+        while True:
+            with self.condition:
+                while self.written - self.read < frame_size and not self.closed:
+                    self.condition.wait()
+
+                count = min(frame_size, self.written - self.read)
+                if count == 0:
+                    return
+
+                index = (self.read + np.arange(count)) % self.capacity
+                frame = self.buffer[index]
+                self.read += count
+            yield frame
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    if not args:
+        print('usage: python wavelet_stream.py <audio file> [wavelet] [level] [--realtime]')
+        sys.exit(1)
+
+    rate, _ = audio_io.load_audio(args[0])
+    frames = file_frames(args[0], realtime='--realtime' in sys.argv)
+
+    for seconds, energies in analyze(frames, rate, args[1] if len(args) > 1 else 'db4',
+            int(args[2]) if len(args) > 2 else 6):
+        print('{:8.3f}s '.format(seconds) + ' '.join('{:9.2e}'.format(e) for e in energies))
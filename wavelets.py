@@ -0,0 +1,201 @@
+'''
+BLOCK-WISE WAVELET TRANSFORM
+pywt.wavedec() needs the whole signal in memory. Here the decomposition is computed one
+block of samples at a time: every level keeps the last dec_len - 1 samples it was given
+(its filter state), so each block continues the convolution exactly where the previous
+one stopped, and the approximation coefficients of one level are pushed straight into the
+next. The result is the same as pywt.wavedec() on the whole signal (for the 'zero' and
+'symmetric' modes), in as much memory as one block plus the coefficients.
+
+wavedec_file() runs it over a .wav a block at a time (see audio_io.iter_blocks). The signal
+is padded with zeros to a multiple of 2**level instead of being cut to a power of two.
+'''
+import numpy as np
+import pywt
+
+import audio_io
+
+#signal extension modes that can be continued block by block
+BLOCK_MODES = ('zero', 'symmetric')
+
+#one level of the transform. pywt's dwt is the full convolution of the extended signal with
+#dec_lo/dec_hi, keeping the odd outputs. count is the index of the next full convolution output
+class DWTLevel(object):
+    def __init__(self, wavelet, mode='symmetric'):
+        if mode not in BLOCK_MODES:
+            raise ValueError('mode has to be one of {}'.format(BLOCK_MODES))
+
+        self.wavelet = pywt.Wavelet(wavelet) if isinstance(wavelet, str) else wavelet
+        self.mode = mode
+        self.dec_lo = np.asarray(self.wavelet.dec_lo)
+        self.dec_hi = np.asarray(self.wavelet.dec_hi)
+        self.taps = len(self.dec_lo) - 1
+
+        #the left extension needs the first samples (symmetric), they are held back until there are enough
+        self.head = np.zeros(0)
+        self.tail = None
+        self.count = 0
+
+    def convolve(self, x):
+        #np.convolve swaps its arguments when the first is the shorter one
+        if len(x) == 0:
+            return np.zeros(0), np.zeros(0)
+
+        ext = np.concatenate([self.tail, x])
+        first = (self.count + 1) % 2
+
+        cA = np.convolve(ext, self.dec_lo, 'valid')[first::2]
+        cD = np.convolve(ext, self.dec_hi, 'valid')[first::2]
+
+        self.count += len(x)
+        self.tail = ext[len(ext) - self.taps:]
+        return cA, cD
+
+    #returns the (cA, cD) coefficients that x completes
+    def push(self, x):
+        x = np.asarray(x, dtype=np.float64)
+
+        if self.tail is None:
+            self.head = np.concatenate([self.head, x])
+            if len(self.head) < self.taps:
+                return np.zeros(0), np.zeros(0)
+
+            if self.mode == 'zero':
+                self.tail = np.zeros(self.taps)
+            else:
+                self.tail = self.head[:self.taps][::-1]
+            x, self.head = self.head, None
+
+        return self.convolve(x)
+
+    #the coefficients that depend on the right extension, after the last push()
+    def flush(self):
+        if self.tail is None:
+            #shorter than the filter: pywt extends those differently, let it do the whole thing
+            if len(self.head) == 0:
+                return np.zeros(0), np.zeros(0)
+            return pywt.dwt(self.head, self.wavelet, self.mode)
+
+        if self.mode == 'zero':
+            return self.convolve(np.zeros(self.taps))
+        return self.convolve(self.tail[::-1])
+
+#a multi level transform, one DWTLevel per level
+class BlockDWT(object):
+    def __init__(self, wavelet, level, mode='symmetric'):
+        self.levels = [DWTLevel(wavelet, mode) for _ in range(level)]
+
+    #returns (cA of the last level, [cD of level 1, ..., cD of the last level]) of what x completes
+    def push(self, x):
+        details = []
+        for level in self.levels:
+            x, cD = level.push(x)
+            details.append(cD)
+        return x, details
+
+    def flush(self):
+        approx = np.zeros(0)
+        details = []
+
+        #every level first takes what the level below it flushed, then flushes itself
+        for level in self.levels:
+            cA, cD = level.push(approx) if len(approx) else (np.zeros(0), np.zeros(0))
+            cA_end, cD_end = level.flush()
+
+            approx = np.concatenate([cA, cA_end])
+            details.append(np.concatenate([cD, cD_end]))
+        return approx, details
+
+#coefficient lengths of every level for a signal of `length` samples, in wavedec's order
+def coefficient_lengths(length, wavelet, level, mode):
+    lengths = []
+    for _ in range(level):
+        length = pywt.dwt_coeff_len(length, wavelet, mode)
+        lengths.append(length)
+    return [lengths[-1]] + lengths[::-1]
+
+#the wavedec() of a signal that comes as blocks, `length` samples in total. Returns
+#[cA_n, cD_n, ..., cD_1] like pywt.wavedec(). With pad the signal is padded with zeros to a
+#multiple of 2**level, so every level halves evenly
+def wavedec_blocks(blocks, length, wavelet, level=None, mode='symmetric', pad=True):
+    wavelet = pywt.Wavelet(wavelet) if isinstance(wavelet, str) else wavelet
+    if level is None:
+        level = pywt.dwt_max_level(length, wavelet.dec_len)
+
+    padding = -length % (2 ** level) if pad else 0
+    lengths = coefficient_lengths(length + padding, wavelet, level, mode)
+
+    #the coefficients are written into place as the blocks come in
+    coeffs = [np.empty(n) for n in lengths]
+    filled = [0] * len(coeffs)
+
+    def store(approx, details):
+        for i, c in enumerate([approx] + details[::-1]):
+            coeffs[i][filled[i]:filled[i] + len(c)] = c
+            filled[i] += len(c)
+
+    dwt = BlockDWT(wavelet, level, mode)
+    for block in blocks:
+        store(*dwt.push(block))
+
+    if padding:
+        store(*dwt.push(np.zeros(padding)))
+    store(*dwt.flush())
+
+    return coeffs
+
+#block-wise wavedec of one channel of an audio file
+def wavedec_file(path, wavelet, level=None, channel=0, mode='symmetric', pad=True,
+        block_frames=audio_io.BLOCK_FRAMES):
+    blocks = audio_io.iter_blocks(path, block_frames, channel=channel)
+    return wavedec_blocks(blocks, audio_io.count_frames(path), wavelet, level, mode, pad)
+
+'''
+SCALOGRAM
+scalogram_image() turns a wavedec tree into one 2-D image instead of drawing every level on
+its own. The level rows are laid out like wavelet1.py's scalogram(): cA_n at the bottom and
+every level twice as tall as the one below it, with at least one pixel row each. Each pixel
+column holds the largest |coefficient| that falls in it, so decimating a long signal down to
+`width` pixels keeps its peaks. All the levels are resampled by a single np.maximum.reduceat
+over their concatenated coefficients.
+'''
+SCALOGRAM_WIDTH = 2048
+SCALOGRAM_HEIGHT = 512
+
+#(rows, width) float array of |coefficients|, row 0 is the top (cD_1)
+def scalogram_image(coeffs, width=SCALOGRAM_WIDTH, height=SCALOGRAM_HEIGHT):
+    magnitudes = np.abs(np.concatenate(coeffs))
+    lengths = np.array([len(c) for c in coeffs])
+    offsets = np.cumsum(lengths) - lengths
+
+    #first coefficient of every pixel column of every level. Where a level has fewer
+    #coefficients than pixels, columns repeat the same start and reduceat gives back that
+    #one coefficient (nearest neighbour), otherwise it takes the max over the column
+    columns = np.arange(width)
+    starts = offsets[:, np.newaxis] + (columns * lengths[:, np.newaxis]) // width
+    levels = np.maximum.reduceat(magnitudes, starts.ravel()).reshape(len(coeffs), width)
+
+    scales = 2.0 ** (np.arange(len(coeffs)) - len(coeffs))
+    rows = np.maximum(np.rint(height * scales).astype(np.int64), 1)
+
+    #top row first
+    return levels[np.repeat(np.arange(len(coeffs)), rows)[::-1]]
+
+#writes the image as .npy (raw magnitudes) or as a grayscale .png, without opening a figure
+def save_scalogram(image, path):
+    if path.endswith('.npy'):
+        np.save(path, image)
+        return path
+
+    import matplotlib.image
+
+    matplotlib.image.imsave(path, image, cmap='gray', vmin=image.min(), vmax=image.max())
+    return path
+
+#one imshow of the whole tree on the current axes
+def plot_scalogram(coeffs, width=SCALOGRAM_WIDTH, height=SCALOGRAM_HEIGHT):
+    import matplotlib.pyplot as plt
+
+    image = scalogram_image(coeffs, width, height)
+    return plt.imshow(image, interpolation='nearest', aspect='auto', extent=[0, 1, 0, 1],
+            vmin=image.min(), vmax=image.max())